@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from collections import deque
+
+
+class AhoCorasick(object):
+    """class to find all of a fixed list of patterns in one pass over a text"""
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.lengths = [len(pattern) for pattern in self.patterns]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for patidx, pattern in enumerate(self.patterns):
+            if(pattern == ""):
+                continue
+            node = 0
+            for char in pattern:
+                if(char not in self.goto[node]):
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(patidx)
+        self._link()
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def firstHits(self, text):
+        """return pattern index -> start of its leftmost occurrence in text"""
+        hits = {}
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        node = 0
+        for pos, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for patidx in output[node]:
+                if(patidx not in hits):
+                    hits[patidx] = pos - self.lengths[patidx] + 1
+        return hits
+
+
+class RefSeqMatcher(object):
+    """class to find exact forward/reverse barcode or primer hits in flank windows"""
+    def __init__(self, refseqs):
+        self.refseqs = refseqs
+        self.forward = AhoCorasick([refseq.f for refseq in refseqs])
+        self.reverse = AhoCorasick([refseq.r for refseq in refseqs])
+
+    def firstHit(self, lseq, rseq):
+        """return (refseq, posL, posR) of the first refseq in list order hit on either side, None if none"""
+        hitsL = self.forward.firstHits(lseq)
+        hitsR = self.reverse.firstHits(rseq)
+        if(len(hitsL) == 0 and len(hitsR) == 0):
+            return None
+        refidx = min(set(hitsL) | set(hitsR))
+        return (self.refseqs[refidx], hitsL.get(refidx, -1), hitsR.get(refidx, -1))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+##folder of the chunk results under the project output folder
+CHECKPOINT_FOLDER = "align_chunks"
+
+
+class AlignCheckpoint(object):
+    """class to commit alignment results per read chunk into the project folder"""
+    MANIFEST = "manifest.json"
+
+    def __init__(self, folder, signature):
+        self.folder = folder
+        self.signature = signature
+
+    def open(self):
+        """prepare the chunk folder, drop chunks written under another signature"""
+        try:
+            if(not os.path.isdir(self.folder)):
+                os.makedirs(self.folder)
+            manifest = os.path.join(self.folder, self.MANIFEST)
+            oldsignature = None
+            if(os.path.exists(manifest)):
+                with open(manifest) as fh_in:
+                    oldsignature = json.load(fh_in).get('signature')
+            if(oldsignature != self.signature):
+                self.clear()
+                tmpfile = manifest + ".tmp"
+                with open(tmpfile, 'w') as fh_out:
+                    json.dump({'signature':self.signature}, fh_out)
+                os.replace(tmpfile, manifest)
+            return (True, None)
+        except (IOError, OSError, ValueError) as e:
+            return (False, e)
+
+    def remove(self):
+        """delete the chunk folder, once the project file holds the alignment it is not needed"""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def clear(self):
+        for filename in os.listdir(self.folder):
+            if(filename.startswith("chunk_")):
+                os.remove(os.path.join(self.folder, filename))
+
+    def chunkfile(self, chunkidx):
+        return os.path.join(self.folder, "chunk_%06d.pkl.gz" % (chunkidx))
+
+    def committed(self):
+        """indexes of the chunks already on disk"""
+        chunks = set()
+        for filename in os.listdir(self.folder):
+            if(filename.startswith("chunk_") and filename.endswith(".pkl.gz")):
+                chunks.add(int(filename[6:-7]))
+        return chunks
+
+    def commit(self, chunkidx, result):
+        """write one chunk result, the rename makes the commit atomic"""
+        chunkfile = self.chunkfile(chunkidx)
+        tmpfile = chunkfile + ".tmp"
+        with gzip.open(tmpfile, "wb") as fh_out:
+            pickle.dump(result, fh_out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, chunkfile)
+
+    def load(self, chunkidx):
+        with gzip.open(self.chunkfile(chunkidx), "rb") as fh_in:
+            return pickle.load(fh_in)
+
+
+def CheckpointFolder(outfolder):
+    return os.path.join(outfolder, CHECKPOINT_FOLDER)
+
+
+def AlignSignature(paras, seqs, barcodes, primers, symbarcode):
+    """hash of everything that decides the alignment of a read chunk"""
+    sha = hashlib.sha1()
+    fileinfo = []
+    for seqfile in paras.Seq_Files:
+        try:
+            fileinfo.append((os.path.basename(seqfile), os.path.getsize(seqfile)))
+        except OSError:
+            fileinfo.append((os.path.basename(seqfile), -1))
+    settings = (len(seqs), paras.AlignChunkSize, paras.DedupReads, symbarcode, paras.PadSeq,
+                paras.UniPrimer, paras.BarcodeLen, paras.FlankingLength, paras.MatchScore,
+                paras.MismatchScore, paras.GapScore, paras.MaxMisMatch, paras.CoverageCap, paras.MaxReadNum,
+                fileinfo)
+    sha.update(repr(settings).encode())
+    for refseqs in (barcodes, primers):
+        for refseq in refseqs:
+            sha.update(repr((refseq.id, refseq.des, refseq.f, refseq.r, refseq.fs, refseq.rs)).encode())
+    if(len(seqs) > 0):
+        sha.update(repr((seqs[0].id, seqs[-1].id)).encode())
+    return sha.hexdigest()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from multiprocessing import Process, Queue
+from time import time, strftime
+
+import DesignCache
+import Parameters
+import ProjectEnviroment
+import SWAlign
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BASES = 'ACGT'
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+
+def _revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+class ErrorProfile(object):
+    """per-base sequencing error rates of the synthetic reads"""
+    def __init__(self, substitution=0.005, insertion=0.005, deletion=0.005,
+                 junkratio=0.05, truncratio=0.02, lowqual=8, highqual=(30,40)):
+        self.substitution = substitution
+        self.insertion = insertion
+        self.deletion = deletion
+        self.junkratio = junkratio
+        self.truncratio = truncratio
+        self.lowqual = lowqual
+        self.highqual = highqual
+
+
+class SyntheticDesign(object):
+    """class to generate a barcode/primer plate layout and MLST reads for it"""
+    def __init__(self, strains=24, loci=5, readsPerBucket=20, hetratio=0.1, hetsites=6,
+                 symbarcode=True, errors=None, seed=1, paras=None):
+        self.strains = strains
+        self.loci = loci
+        self.readsPerBucket = readsPerBucket
+        self.hetratio = hetratio
+        self.hetsites = hetsites
+        self.symbarcode = symbarcode
+        self.errors = errors if errors is not None else ErrorProfile()
+        self.paras = paras if paras is not None else Parameters.Parameters()
+        self.random = random.Random(seed)
+        self.barcodes = []
+        self.primers = []
+        self.hetbuckets = set()
+        ##read id -> (strain, reverse strand) of the reads that carry their barcodes, set by reads()
+        self.origins = {}
+        self._design()
+
+    def _randseq(self, length):
+        return ''.join(self.random.choice(BASES) for i in range(length))
+
+    def _design(self):
+        barcodelen = self.paras.BarcodeLen
+        for i in range(self.strains):
+            barcodeF = self._randseq(barcodelen)
+            if(self.symbarcode):
+                barcodeR = barcodeF
+            else:
+                barcodeR = self._randseq(barcodelen)
+            self.barcodes.append(("Strain%03d" % i, barcodeF, barcodeR))
+        for i in range(self.loci):
+            amplicon = self._randseq(self.random.randint(350, 650))
+            self.primers.append(("LOCUS%02d" % i, self._randseq(20), self._randseq(20), amplicon))
+        for strain in self.barcodes:
+            for locus in self.primers:
+                if(self.random.random() < self.hetratio):
+                    self.hetbuckets.add((strain[0], locus[0]))
+
+    def _allele(self, amplicon, strain, locus):
+        """second allele of a heterozygous bucket, fixed per strain x locus"""
+        rand = random.Random(strain + locus)
+        allele = list(amplicon)
+        for pos in rand.sample(range(len(amplicon)), self.hetsites):
+            allele[pos] = rand.choice([b for b in BASES if b != amplicon[pos]])
+        return ''.join(allele)
+
+    def _mutate(self, seq):
+        bases = []
+        quals = []
+        errors = self.errors
+        for base in seq:
+            x = self.random.random()
+            if(x < errors.substitution):
+                bases.append(self.random.choice(BASES))
+                quals.append(errors.lowqual)
+            elif(x < errors.substitution + errors.deletion):
+                continue
+            elif(x < errors.substitution + errors.deletion + errors.insertion):
+                bases.append(base)
+                quals.append(self.random.randint(*errors.highqual))
+                bases.append(self.random.choice(BASES))
+                quals.append(errors.lowqual)
+            else:
+                bases.append(base)
+                quals.append(self.random.randint(*errors.highqual))
+        return (''.join(bases), quals)
+
+    def reads(self):
+        """yield (id, sequence, phred qualities) for every synthetic read"""
+        pad = self.paras.PadSeq
+        uni = self.paras.UniPrimer
+        readnum = 0
+        for strain, barcodeF, barcodeR in self.barcodes:
+            for locus, primerF, primerR, amplicon in self.primers:
+                ishet = (strain, locus) in self.hetbuckets
+                allele2 = self._allele(amplicon, strain, locus) if ishet else amplicon
+                for i in range(self.readsPerBucket):
+                    insert = amplicon if (not ishet or i % 2 == 0) else allele2
+                    seq = (self._randseq(self.random.randint(0, 3)) + pad + barcodeF + uni + primerF +
+                           insert + _revcomp(primerR) + _revcomp(uni) + _revcomp(barcodeR) +
+                           _revcomp(pad) + self._randseq(self.random.randint(0, 3)))
+                    x = self.random.random()
+                    intact = False
+                    if(x < self.errors.junkratio):
+                        seq = self._randseq(len(seq))
+                    elif(x < self.errors.junkratio + self.errors.truncratio):
+                        seq = seq[:self.random.randint(20, 60)]
+                    else:
+                        intact = True
+                    reverse = self.random.random() < 0.5
+                    if(reverse):
+                        seq = _revcomp(seq)
+                    seq, quals = self._mutate(seq)
+                    readnum += 1
+                    if(intact):
+                        self.origins["read%07d" % readnum] = (strain, reverse)
+                    yield ("read%07d" % readnum, seq, quals)
+
+    def write(self, folder):
+        """write barcode, primer and FASTQ files, return their paths"""
+        barcodefile = os.path.join(folder, "barcodes.csv")
+        primerfile = os.path.join(folder, "primers.csv")
+        seqfile = os.path.join(folder, "reads.fastq")
+        with open(barcodefile, 'w') as fh_out:
+            for strain, barcodeF, barcodeR in self.barcodes:
+                if(self.symbarcode):
+                    fh_out.write("%s,%s\n" % (strain, barcodeF))
+                else:
+                    fh_out.write("%s,%s,%s\n" % (strain, barcodeF, barcodeR))
+        with open(primerfile, 'w') as fh_out:
+            for locus, primerF, primerR, amplicon in self.primers:
+                fh_out.write("%s,%s,%s\n" % (locus, primerF, primerR))
+        with open(seqfile, 'w') as fh_out:
+            for readid, seq, quals in self.reads():
+                fh_out.write("@%s\n%s\n+\n%s\n" % (readid, seq, ''.join(chr(q + 33) for q in quals)))
+        return (barcodefile, primerfile, seqfile)
+
+
+def _SWAligner(paras, banded):
+    sw = SWAlign.LocalAlignment(SWAlign.NucleotideScoringMatrix(paras.MatchScore, paras.MismatchScore),
+                                paras.GapScore)
+    if(banded):
+        return lambda ref, query, minscore: sw.align(ref, query, min_score=minscore)
+    return lambda ref, query, minscore: sw.align(ref, query)
+
+
+ALIGNERS = {
+    'swalign': lambda paras: _SWAligner(paras, False),
+    'swalign-banded': lambda paras: _SWAligner(paras, True),
+}
+
+
+def _PeakMemory():
+    """(self, children) peak RSS in MB, None where unavailable
+
+    Children only count once they have exited and been waited for, so the pool workers are
+    not in it before the pool is closed.
+    """
+    if(resource is None):
+        return (None, None)
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    selfrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    childrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return (round(selfrss, 1), round(childrss, 1))
+
+
+def _WorkerPeakMemory(pids):
+    """highest peak RSS in MB of the running pool workers, None where /proc is unavailable"""
+    peaks = []
+    for pid in pids:
+        try:
+            with open("/proc/%s/status" % pid) as fh_in:
+                for line in fh_in:
+                    if(line.startswith("VmHWM:")):
+                        peaks.append(int(line.split()[1]) / 1024.0)
+        except IOError:
+            continue
+    if(len(peaks) == 0):
+        return None
+    return round(max(peaks), 1)
+
+
+def BenchAligner(name, paras, design, seqs, maxaligns=2000):
+    """align both barcode windows of the reads against the barcodes they were generated with"""
+    align = ALIGNERS[name](paras)
+    padlen = max(paras.PadLength - paras.FlankingLength, 0)
+    reglen = 2*paras.FlankingLength + paras.BarcodeLen
+    totallen = padlen + reglen
+    barcodes = dict((strain, (barcodeF, barcodeR)) for strain, barcodeF, barcodeR in design.barcodes)
+    pairs = []
+    for seq in seqs:
+        if(len(pairs) >= maxaligns):
+            break
+        ##junk and truncated reads carry no barcode
+        if(seq.id not in design.origins):
+            continue
+        strain, reverse = design.origins[seq.id]
+        barcodeF, barcodeR = barcodes[strain]
+        seqstr = str(seq.seq)
+        seq_L = seqstr[padlen:totallen]
+        seq_Rr = _revcomp(seqstr[len(seqstr) - totallen:len(seqstr) - padlen])
+        ##as in the barcode search, the left window is aligned to the forward barcode of the read strand
+        if(reverse):
+            pairs += [(barcodeR, seq_L), (barcodeF, seq_Rr)]
+        else:
+            pairs += [(barcodeF, seq_L), (barcodeR, seq_Rr)]
+    minscore = (paras.BarcodeLen - paras.MaxMisMatch) * paras.MatchScore + \
+               max(paras.GapScore, paras.MismatchScore) * paras.MaxMisMatch
+    t0 = time()
+    cells = 0
+    for barcode, window in pairs:
+        align(barcode, window, minscore)
+        cells += len(barcode) * len(window)
+    wall = time() - t0
+    return {'stage':'swalign', 'engine':name, 'items':len(pairs), 'wall':round(wall, 4),
+            'items_per_sec':round(len(pairs) / wall, 2) if wall > 0 else None,
+            'cells_per_sec':round(cells / wall, 2) if wall > 0 else None}
+
+
+def BenchScale(design, paras, engines, stages, queue):
+    """run one scale in its own process so peak memory is per scale"""
+    workfolder = tempfile.mkdtemp(prefix="mlstez_bench_")
+    results = []
+    try:
+        barcodefile, primerfile, seqfile = design.write(workfolder)
+        paras.Seq_Files = [seqfile]
+        paras.Barcode_File = barcodefile
+        paras.Primer_File = primerfile
+        paras.Out_Folder = workfolder
+        paras.update()
+        ##compiled designs of synthetic plates stay out of the user's design cache
+        DesignCache.DESIGN_FOLDER = os.path.join(workfolder, "designs")
+        projenv = ProjectEnviroment.ProjectEnviroment(paras, None)
+        isokay, error = projenv.resetProfile()
+        if(not isokay):
+            raise RuntimeError(error)
+        jobs = [('load', projenv.loadFiles), ('align', projenv.alignSeqs),
+                ('sort', projenv.sortAlignedSeqs), ('lengths', projenv.locusLengths)]
+        if('consensus' in stages):
+            jobs.append(('consensus', projenv.GenerateConsensus))
+        if('het' in stages):
+            jobs.append(('het', projenv.HetSearch))
+        for jobname, job in jobs:
+            isokay, error = job()
+            if(not isokay):
+                raise RuntimeError("%s failed: %s" % (jobname, error))
+            if(jobname == 'load'):
+                for engine in engines:
+                    results.append(BenchAligner(engine, paras, design, projenv.Seqs))
+            selfrss = _PeakMemory()[0]
+            workerrss = _WorkerPeakMemory(projenv.Workers.pids())
+            for record in projenv.Profile.stages:
+                if(record.name in [result.get('stage') for result in results]):
+                    continue
+                info = record.todict()
+                info['stage'] = info.pop('name')
+                info['peak_rss_mb'] = selfrss
+                info['peak_worker_rss_mb'] = workerrss
+                results.append(info)
+        ##the workers are counted as children once the pool is closed and joined
+        projenv.closeWorkers()
+        queue.put((True, (results, _PeakMemory()[1])))
+    except Exception as e:
+        queue.put((False, str(e)))
+    finally:
+        shutil.rmtree(workfolder, ignore_errors=True)
+
+
+def RunBenchmark(scales, strains, loci, engines, stages, threads, muscle, seed, outfile, errors=None,
+                 hetratio=0.1, hetsites=6, symbarcode=True):
+    errors = errors if errors is not None else ErrorProfile()
+    runinfo = {'date':strftime("%Y-%m-%d %H:%M:%S"), 'python':platform.python_version(),
+               'platform':platform.platform(), 'seed':seed, 'threads':threads,
+               'errors':{'substitution':errors.substitution, 'insertion':errors.insertion,
+                         'deletion':errors.deletion},
+               'hetratio':hetratio, 'hetsites':hetsites, 'symbarcode':symbarcode, 'scales':[]}
+    for readsPerBucket in scales:
+        paras = Parameters.Parameters()
+        paras.Threads = threads
+        paras.MuscleCMD = muscle
+        design = SyntheticDesign(strains=strains, loci=loci, readsPerBucket=readsPerBucket, hetratio=hetratio,
+                                 hetsites=hetsites, symbarcode=symbarcode, errors=errors, seed=seed,
+                                 paras=paras)
+        readnum = strains * loci * readsPerBucket
+        sys.stderr.write("Benchmarking %s reads (%s strains x %s loci)...\n" % (readnum, strains, loci))
+        queue = Queue()
+        child = Process(target=BenchScale, args=(design, paras, engines, stages, queue))
+        child.start()
+        isokay, results = queue.get()
+        child.join()
+        if(not isokay):
+            sys.stderr.write("Error: %s\n" % results)
+            return False
+        results, childrss = results
+        runinfo['scales'].append({'reads':readnum, 'strains':strains, 'loci':loci,
+                                  'reads_per_bucket':readsPerBucket, 'peak_child_rss_mb':childrss,
+                                  'results':results})
+    with open(outfile, 'w') as fh_out:
+        json.dump(runinfo, fh_out, indent=2)
+    sys.stderr.write("Results written to %s\n" % outfile)
+    return True
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(prog='Benchmark.py', description='Benchmark MLSTEZ stages on synthetic reads')
+    parser.add_argument('-s', dest='Scales', default='5,20,50',
+                        help='reads per strain x locus for each scale, default: 5,20,50')
+    parser.add_argument('-n', dest='Strains', type=int, default=24, help='number of strains, default: 24')
+    parser.add_argument('-l', dest='Loci', type=int, default=5, help='number of loci, default: 5')
+    parser.add_argument('-e', dest='Engines', default='swalign,swalign-banded',
+                        help='alignment engines to compare (%s), default: swalign,swalign-banded'
+                        % ','.join(sorted(ALIGNERS)))
+    parser.add_argument('-t', dest='Threads', type=int, default=1, help='worker threads, default: 1')
+    parser.add_argument('-m', dest='Muscle', default='',
+                        help='MUSCLE command; consensus and het stages run only when it is given')
+    parser.add_argument('-E', dest='Errors', default='0.005,0.005,0.005',
+                        help='substitution,insertion,deletion rates per base, default: 0.005,0.005,0.005')
+    parser.add_argument('--het', dest='Het', default='0.1,6',
+                        help='share of heterozygous strain x locus buckets and variant sites per allele, '
+                             'default: 0.1,6')
+    parser.add_argument('--asym', dest='Asym', action='store_true',
+                        help='use different forward and reverse barcodes for each strain')
+    parser.add_argument('-r', dest='Seed', type=int, default=1, help='random seed, default: 1')
+    parser.add_argument('-o', dest='Out_File', default='BenchmarkResults.json',
+                        help='results file, default: BenchmarkResults.json')
+    args = parser.parse_args()
+    stages = ['align']
+    if(args.Muscle != ""):
+        stages += ['consensus', 'het']
+    scales = [int(scale) for scale in args.Scales.split(',')]
+    engines = args.Engines.split(',')
+    substitution, insertion, deletion = [float(rate) for rate in args.Errors.split(',')]
+    hetratio, hetsites = args.Het.split(',')
+    errors = ErrorProfile(substitution=substitution, insertion=insertion, deletion=deletion)
+    isokay = RunBenchmark(scales, args.Strains, args.Loci, engines, stages, args.Threads,
+                          args.Muscle, args.Seed, args.Out_File, errors, float(hetratio), int(hetsites),
+                          not args.Asym)
+    sys.exit(0 if isokay else 1)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import queue
+import ConsensusSeqs
+import HetSearchParallel
+import LengthHistogram
+import RunProfile
+
+##a locus length range counts as settled once this many chunks in a row left it unchanged
+STABLE_CHUNKS = 3
+
+
+class BucketPipeline(object):
+    """class to build consensus and search heterozygosity of strain x locus buckets while reads are still aligned
+
+    A bucket is scheduled once the length range of its locus has settled and it holds
+    Pipeline_Depth x Max_ReadNum reads in that range; later reads of the bucket are not used.
+    Chunks are taken in chunk order whatever order they finish in, so the same input always
+    schedules the same reads.
+    """
+    def __init__(self, projenv, consensus=True, hetsearch=False):
+        self.projenv = projenv
+        self.depth = max(projenv.parameters.PipelineDepth, 1) * projenv.parameters.MaxReadNum
+        self.consensus = consensus
+        self.hetsearch = hetsearch
+        self.buckets = {}
+        self.hists = {}
+        self.ranges = {}
+        self.scheduled = set()
+        ##chunk index -> aligned reads of chunks that finished ahead of an earlier one
+        self.waiting = {}
+        self.nextchunk = 0
+        self.ConsSeqs = {}
+        self.HetInfo = {}
+        self.profile = RunProfile.RunProfile()
+        self.error = None
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def addChunk(self, chunkidx, alignedseqs):
+        """take the reads of one aligned chunk, chunks are used once all earlier chunks are in"""
+        if(self.error is not None):
+            return
+        self.waiting[chunkidx] = alignedseqs
+        try:
+            while self.nextchunk in self.waiting:
+                self._addChunk(self.waiting.pop(self.nextchunk))
+                self.nextchunk += 1
+        except Exception as e:
+            ##reported by finish, the alignment itself goes on
+            self.error = e
+            self.waiting = {}
+
+    def _addChunk(self, alignedseqs):
+        """schedule the buckets that became ready with the reads of one chunk"""
+        genes = set()
+        for alignSeq in alignedseqs:
+            if(alignSeq.strain == "" or alignSeq.gene == ""):
+                continue
+            gene = alignSeq.gene
+            genes.add(gene)
+            if(gene not in self.hists):
+                self.hists[gene] = LengthHistogram.LengthHistogram()
+            self.hists[gene].add(alignSeq.LocusLength())
+            bucket = (alignSeq.strain, gene)
+            if(bucket not in self.scheduled):
+                self.buckets.setdefault(bucket, []).append(alignSeq)
+        for gene in genes:
+            lenRange = self.hists[gene].lengthRange()
+            lastRange, stable = self.ranges.get(gene, (None, 0))
+            stable = stable + 1 if lenRange == lastRange else 0
+            self.ranges[gene] = (lenRange, stable)
+        for bucket in list(self.buckets):
+            lenRange, stable = self.ranges[bucket[1]]
+            if(stable < STABLE_CHUNKS):
+                continue
+            geneSeqs = self.buckets[bucket]
+            passed = 0
+            for alignSeq in geneSeqs:
+                seqlen = alignSeq.TrimmedLength()
+                if(seqlen >= lenRange['s1'] and seqlen <= lenRange['s2']):
+                    passed += 1
+            if(passed >= self.depth):
+                self.scheduled.add(bucket)
+                del self.buckets[bucket]
+                self._queue.put((bucket[0], bucket[1], geneSeqs, lenRange))
+
+    def finish(self):
+        """wait for the scheduled buckets, return (True, None) or (False, error)"""
+        self._queue.put(None)
+        self._thread.join()
+        self.buckets = {}
+        self.waiting = {}
+        ##the buckets ran beside the alignment, their time is not added to the run total
+        for record in self.profile.stages:
+            record.concurrent = True
+            self.projenv.Profile.stages.append(record)
+        if(self.error is not None):
+            return (False, self.error)
+        return (True, None)
+
+    def _run(self):
+        ##MUSCLE runs as a subprocess, so a few threads keep several buckets busy beside the aligners
+        with self.profile.stage('pipelined buckets'):
+            self.consseqs = ConsensusSeqs.ConsensusSeqs(self.projenv)
+            self.consseqs.profile = self.profile
+            self.hetsearcher = HetSearchParallel.HetSearch(self.projenv)
+            with ThreadPoolExecutor(max(self.projenv.parameters.Threads, 1)) as executor:
+                while True:
+                    task = self._queue.get()
+                    if(task is None):
+                        break
+                    executor.submit(self._bucket, *task)
+
+    def _bucket(self, strain, gene, geneSeqs, lenRange):
+        if(self.error is not None):
+            return
+        try:
+            if(self.consensus):
+                self.ConsSeqs[(strain, gene)] = self.consseqs.bucketConsensus(strain, gene, geneSeqs, lenRange)
+            if(self.hetsearch):
+                hetinfo = self.hetsearcher.bucketHet(strain, gene, geneSeqs, lenRange)
+                self.profile.muscle(hetinfo.musclecalls, hetinfo.muscletime)
+                self.HetInfo[(strain, gene)] = hetinfo
+            self.profile.count('buckets')
+        except Exception as e:
+            self.error = e
@@ -1,53 +1,39 @@
 #!/usr/bin/env python
 
+import heapq
+from time import time
+import ReferencePileup
+
 
 class ConsensusSeqs(object):
     def __init__(self, projenv):
         self.parameters = projenv.parameters
         self.SortedSeqs = projenv.SortedSeqs
+        self.SeqQuals = projenv.SeqQuals
         self.locusLengthRange = projenv.locusLengthRange
+        self.References = projenv.References
         self.msgHandle = projenv
+        self.profile = projenv.Profile
         self.ConsSeqs = {}
     
-    def makeConsensus(self):
-        import tempfile
-        from Bio.Align.Applications import MuscleCommandline
-        from Bio import AlignIO
-        from io import StringIO
-        from Bio.SeqRecord import SeqRecord
-        from Bio.Seq import Seq
-        from Bio.Alphabet import generic_dna
-        import os
+    def makeConsensus(self, pipelined=None):
+        ##pipelined maps (strain, gene) to the consensus already built while reads were aligned
         self.msgHandle.showMsg('Generating consensus sequences...', "")
         #stderr.write ('\nGenerating consensus sequences...')
         ConsSeqs = {}
-        MUSCLE = self.parameters.MuscleCMD
         try:
             for strain in self.SortedSeqs:
                 strainSeqs = self.SortedSeqs[strain]
                 for gene in strainSeqs:
                     if gene == "unmapped":
                         continue
-                    geneSeqs = strainSeqs[gene]
-                    lenRange = self.locusLengthRange[gene]
-                    sortedseqs = self._SortSeqs(geneSeqs, lenRange, self.parameters.MinReadNum,
-                                                self.parameters.MaxReadNum)
-                    if sortedseqs != "":
-                        tmpfile = tempfile.NamedTemporaryFile('w', delete=False)
-                        tmpname = tmpfile.name
-                        for seq in sortedseqs:
-                            tmpfile.write(seq.format("fasta"))
-                        tmpfile.flush()
-                        tmpfile.close()
-                        cmdline = MuscleCommandline(MUSCLE, input=tmpname)
-                        # print(cmdline)
-                        stdout, stderr = cmdline()
-                        os.remove(tmpname)
-                        align = AlignIO.read(StringIO(stdout), "fasta")
-                        #print (align)
-                        consensus = self._AlignConsensus(align)
-                        #print (consensus)
-                        seqrec = SeqRecord(Seq(consensus, generic_dna), id=strain, description=gene)
+                    if pipelined is not None and (strain, gene) in pipelined:
+                        self.profile.count('pipelined_loci')
+                        seqrec = pipelined[(strain, gene)]
+                    else:
+                        seqrec = self.bucketConsensus(strain, gene, strainSeqs[gene],
+                                                      self.locusLengthRange[gene])
+                    if seqrec is not None:
                         if gene not in ConsSeqs:
                             genecons = []
                             genecons.append(seqrec)
@@ -62,30 +48,96 @@ class ConsensusSeqs(object):
         except Exception as e:
             return False, e
     
+    def bucketConsensus(self, strain, gene, geneSeqs, lenRange):
+        """consensus SeqRecord of one strain x locus, None when it has too few reads"""
+        import tempfile
+        from Bio.Align.Applications import MuscleCommandline
+        from Bio import AlignIO
+        from io import StringIO
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        from Bio.Alphabet import generic_dna
+        import os
+        sortedseqs = self._SortSeqs(geneSeqs, lenRange, self.parameters.MinReadNum,
+                                    self.parameters.MaxReadNum)
+        if sortedseqs == "":
+            return None
+        self.profile.reads(len(sortedseqs))
+        uniqueseqs = self._UniqueSeqs(sortedseqs)
+        self.profile.count('unique_reads', len(uniqueseqs))
+        if len(uniqueseqs) == 1:
+            ##identical reads, nothing to align or vote on
+            self.profile.count('single_unique_loci')
+            consensus = uniqueseqs[0][0]
+        elif gene in self.References:
+            consensus = self._PileupConsensus(self.References[gene], uniqueseqs, lenRange)
+        else:
+            tmpfile = tempfile.NamedTemporaryFile('w', delete=False)
+            tmpname = tmpfile.name
+            weights = {}
+            for i, (seq, count) in enumerate(uniqueseqs):
+                weights["u%d" % i] = count
+                tmpfile.write(">u%d\n%s\n" % (i, seq))
+            tmpfile.flush()
+            tmpfile.close()
+            cmdline = MuscleCommandline(self.parameters.MuscleCMD, input=tmpname)
+            # print(cmdline)
+            t0 = time()
+            stdout, stderr = cmdline()
+            self.profile.muscle(1, time() - t0)
+            os.remove(tmpname)
+            align = AlignIO.read(StringIO(stdout), "fasta")
+            #print (align)
+            consensus = self._AlignConsensus(align, weights)
+        #print (consensus)
+        return SeqRecord(Seq(consensus, generic_dna), id=strain, description=gene)
+    
     def _SortSeqs(self,alnseqs,lenRange,minReadNum,maxReadNum):
     
         if len(alnseqs) < minReadNum : return ""
         
-        seqrec = {}
-        scorerec = {}
+        passedseqs = []
         for alnseq in alnseqs:
-            seq = alnseq.TrimPrimer()
-            if(len(seq) < lenRange['s1'] or len(seq) > lenRange['s2']) : continue
-            scores = seq.letter_annotations["phred_quality"]
-            avescore = sum(scores)/len(scores)
-            seqrec[seq.id] = seq
-            scorerec[seq.id] = avescore
+            seqlen = alnseq.TrimmedLength()
+            if(seqlen < lenRange['s1'] or seqlen > lenRange['s2']) : continue
+            passedseqs.append(alnseq)
             
-        if(len(seqrec) < minReadNum):return ""
+        if(len(passedseqs) < minReadNum):return ""
         
-        sorted_ids = sorted(scorerec, key=scorerec.get,reverse=True)
+        topseqs = heapq.nlargest(maxReadNum-1, passedseqs, key=self._MeanQuality)
         sortedseqs = []
-        for seqid in sorted_ids:
-            sortedseqs.append(seqrec[seqid])
+        for alnseq in topseqs:
+            sortedseqs.append(alnseq.PrimerView().seq)
         
-        return sortedseqs[:maxReadNum-1]
+        return sortedseqs
+    
+    def _PileupConsensus(self, reference, uniqueseqs, lenRange=None):
+        t0 = time()
+        pileup = ReferencePileup.ReferencePileup(reference, self.parameters, lenRange)
+        for seq, count in uniqueseqs:
+            pileup.add(seq, count)
+        consensus = pileup.consensus()
+        self.profile.count('pileup_loci')
+        self.profile.count('pileup_seconds', time() - t0)
+        return consensus
+    
+    def _UniqueSeqs(self, seqs):
+        """collapse identical reads into (sequence, count), in order of first appearance"""
+        counts = {}
+        for seq in seqs:
+            counts[seq] = counts.get(seq, 0) + 1
+        return list(counts.items())
+    
+    def _MeanQuality(self, alnseq):
+        seqidx = getattr(alnseq, 'seqidx', -1)
+        if(seqidx >= 0 and seqidx < len(self.SeqQuals)):
+            return self.SeqQuals[seqidx]
+        ##reads from projects saved without precomputed qualities
+        scores = alnseq.TrimPrimer().letter_annotations["phred_quality"]
+        return sum(scores)/len(scores)
     
-    def _AlignConsensus(self, alignment):
+    def _AlignConsensus(self, alignment, weights=None):
+        ##weights maps record ids to the number of reads each aligned sequence stands for
     
         consensus = ''
         con_len = alignment.get_alignment_length()
@@ -100,11 +152,12 @@ class ConsensusSeqs(object):
             for record in alignment._records:
     
                 if n < len(record.seq):
+                    weight = 1 if weights is None else weights[record.id]
                     if record.seq[n] not in base_dict:
-                        base_dict[record.seq[n]] = 1
+                        base_dict[record.seq[n]] = weight
                     else:
-                        base_dict[record.seq[n]] += 1
-                    num_bases = num_bases + 1
+                        base_dict[record.seq[n]] += weight
+                    num_bases = num_bases + weight
     
             max_bases = []
             max_size = 0
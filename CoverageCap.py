@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import heapq
+from Bio.Seq import Seq
+import LengthHistogram
+
+
+class CoverageCap(object):
+    """class to keep the best reads of every strain x locus and only count the others
+
+    Aligns are (seqidx, barcode, strain, alnBarcode, gene, alnPrimer) tuples as returned by
+    AlignChunk. Each bucket keeps the cap reads within the running locus length range first,
+    then those with the highest mean quality, ties going to the earlier read; the reads
+    pushed out are recorded by locus length only.
+    """
+    def __init__(self, cap, quals):
+        self.cap = cap
+        self.quals = quals
+        self.heaps = {}
+        self.others = []
+        ##gene -> running length range of the locus
+        self.ranges = {}
+        ##(strain, gene) -> LengthHistogram of the reads that are only counted
+        self.dropped = {}
+        self.numdropped = 0
+        ##read indexes pushed out of a bucket, their records can be released
+        self.droppedidxs = []
+
+    def setRanges(self, lengthhists):
+        """update the length ranges from gene -> LengthHistogram, re-rank buckets whose range moved"""
+        for gene in lengthhists:
+            if(len(lengthhists[gene]) == 0):
+                continue
+            lenRange = lengthhists[gene].lengthRange()
+            if(self.ranges.get(gene) == lenRange):
+                continue
+            self.ranges[gene] = lenRange
+            for bucket in self.heaps:
+                if(bucket[1] == gene):
+                    heap = [self._entry(entry[3]) for entry in self.heaps[bucket]]
+                    heapq.heapify(heap)
+                    self.heaps[bucket] = heap
+
+    def _entry(self, align):
+        length = align[5].rs - align[5].le
+        lenRange = self.ranges.get(align[4])
+        inrange = lenRange is None or (length >= lenRange['s1'] and length <= lenRange['s2'])
+        return (inrange, self.quals[align[0]], -align[0], align)
+
+    def add(self, align):
+        strain, gene = align[2], align[4]
+        if(strain == "" or gene == ""):
+            self.others.append(align)
+            return
+        bucket = (strain, gene)
+        if(bucket not in self.heaps):
+            self.heaps[bucket] = []
+        heap = self.heaps[bucket]
+        entry = self._entry(align)
+        if(len(heap) < self.cap):
+            heapq.heappush(heap, entry)
+            return
+        dropped = heapq.heappushpop(heap, entry)[3]
+        if(bucket not in self.dropped):
+            self.dropped[bucket] = LengthHistogram.LengthHistogram()
+        self.dropped[bucket].add(dropped[5].rs - dropped[5].le)
+        self.droppedidxs.append(dropped[0])
+        self.numdropped += 1
+
+    def aligns(self):
+        """the kept aligns in read order"""
+        aligns = list(self.others)
+        for heap in self.heaps.values():
+            aligns += [entry[3] for entry in heap]
+        aligns.sort(key=lambda align: align[0])
+        return aligns
+
+
+def ReleaseRead(seq):
+    """drop the sequence and qualities of a SeqRecord, its id and description stay"""
+    seq.letter_annotations = {}
+    seq.seq = Seq("")
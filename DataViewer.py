@@ -8,6 +8,7 @@ from numpy import arange
 import matplotlib.pyplot as plt
 import sys
 import SeqViewDlg
+import LengthHistogram
 
 
 class ImageViewer(QWidget):
@@ -60,21 +61,42 @@ class ImageViewer(QWidget):
         colnum = len(data)
         pos = list(range(colnum))
         w = min(0.15*max(colnum,1.0),0.5)
+        boxstats = []
         for i in range(colnum):
-            k = gaussian_kde(data[i])
-            m = k.dataset.min()
-            M = k.dataset.max()
+            hist = data[i]
+            if(not isinstance(hist, LengthHistogram.LengthHistogram)):
+                ##projects saved before length histograms were introduced
+                hist = LengthHistogram.LengthHistogram()
+                for length in data[i]:
+                    hist.add(length)
+            lengths = hist.lengths()
+            k = gaussian_kde(lengths, weights=hist.weights())
+            m = lengths[0]
+            M = lengths[-1]
             x = arange(m,M,(M-m)/100.)
             v = k.evaluate(x)
             v = v/v.max()*w
             ax.fill_betweenx(x,i,v+i,facecolor='y',alpha=0.3)
             ax.fill_betweenx(x,i,-v+i,facecolor='y',alpha=0.3)
-        ax.boxplot(data,notch=1,positions=pos,vert=1)
+            boxstats.append(self._BoxStats(hist))
+        ax.bxp(boxstats,positions=pos,shownotches=True,vert=True)
         #ax.boxplot(data,'gD')
         ax.set_xticklabels(locusnames,rotation=40)
         ax.set_title("Length distribution of loci")
         self.canvas.draw()
     
+    def _BoxStats(self, hist):
+        q1 = hist.quantile(0.25)
+        med = hist.quantile(0.5)
+        q3 = hist.quantile(0.75)
+        iqr = q3 - q1
+        notch = 1.57 * iqr / (hist.total ** 0.5)
+        lengths = hist.lengths()
+        inner = [l for l in lengths if(l >= q1 - 1.5*iqr and l <= q3 + 1.5*iqr)]
+        fliers = [l for l in lengths if(l < inner[0] or l > inner[-1])]
+        return {'med':med, 'q1':q1, 'q3':q3, 'whislo':inner[0], 'whishi':inner[-1],
+                'cilo':med - notch, 'cihi':med + notch, 'fliers':fliers}
+    
     def plotAlignRatio(self, data):
         ax = self.figure.add_subplot(111)
         #data1 = [100,10,5]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import pickle
+import numpy as np
+import AhoCorasick
+import SeqAlignParallel
+
+DESIGN_FOLDER = os.path.join(os.path.expanduser("~"), ".mlstez", "designs")
+##bump when the compiled content changes, old artifacts are then rebuilt
+DESIGN_VERSION = 2
+##reference pairs compared per numpy pass of the edit distance
+PAIR_BLOCK = 100000
+
+
+class CompiledDesign(object):
+    """class to store a validated barcode/primer plate layout with its distances and search indexes"""
+    def __init__(self, key, barcodes, primers, symbarcode):
+        self.key = key
+        self.path = ""
+        self.barcodes = barcodes
+        self.primers = primers
+        self.symbarcode = symbarcode
+        ##set name -> (minimum edit distance, [(id1, id2, distance)] of the pairs within 2 x MaxMisMatch)
+        self.distances = {}
+        self.warnings = []
+        self.barcodematcher = None
+        self.primermatcher = None
+        self.pairdecoder = None
+
+    def exactSafe(self, setname, maxmismatch):
+        """True when no two sequences of the set are within maxmismatch edits of each other"""
+        mindist = self.distances[setname][0]
+        return mindist is None or mindist > maxmismatch
+
+    def summary(self, maxmismatch):
+        lines = []
+        for setname in sorted(self.distances):
+            mindist, closepairs = self.distances[setname]
+            if(mindist is None):
+                continue
+            collisions = [pair for pair in closepairs if pair[2] <= maxmismatch]
+            lines.append("%s: minimum edit distance %s, %s pairs within %s, %s within %s" %(
+                setname, mindist, len(closepairs), 2*maxmismatch, len(collisions), maxmismatch))
+        return lines
+
+
+def DesignKey(paras):
+    """hash of the barcode and primer files and the settings that go into a compiled design"""
+    sha = hashlib.sha1()
+    settings = (DESIGN_VERSION, paras.BarcodeLen, paras.MatchScore, paras.MismatchScore, paras.GapScore,
+                paras.MaxMisMatch, paras.BandedAlign)
+    sha.update(repr(settings).encode())
+    for designfile in (paras.Barcode_File, paras.Primer_File):
+        with open(designfile, 'rb') as fh_in:
+            sha.update(hashlib.sha1(fh_in.read()).digest())
+    return sha.hexdigest()
+
+def LoadDesign(key, folder=None):
+    """return the compiled design of key, None if it was not compiled before or cannot be read"""
+    if(folder is None):
+        folder = DESIGN_FOLDER
+    designfile = os.path.join(folder, key + ".design")
+    if(not os.path.isfile(designfile)):
+        return None
+    try:
+        with open(designfile, 'rb') as fh_in:
+            design = pickle.load(fh_in)
+    except Exception:
+        return None
+    if(getattr(design, 'key', None) != key):
+        return None
+    design.path = designfile
+    return design
+
+def SaveDesign(design, folder=None):
+    """write the compiled design, the rename keeps readers from seeing a partial file"""
+    if(folder is None):
+        folder = DESIGN_FOLDER
+    if(not os.path.isdir(folder)):
+        os.makedirs(folder)
+    designfile = os.path.join(folder, design.key + ".design")
+    tmpfile = designfile + ".%s.tmp" %(os.getpid())
+    with open(tmpfile, 'wb') as fh_out:
+        pickle.dump(design, fh_out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpfile, designfile)
+    design.path = designfile
+    return designfile
+
+def CompileDesign(key, barcodes, primers, symbarcode, paras):
+    """validate the barcode and primer sets, measure their distances and build the search indexes"""
+    design = CompiledDesign(key, barcodes, primers, symbarcode)
+    _CheckDesign(design, paras)
+    maxdist = 2 * paras.MaxMisMatch
+    if(symbarcode):
+        design.distances['barcodes'] = _SetDistances(_UniqueSeqs(barcodes, 'f'), maxdist)
+    else:
+        forward = _UniqueSeqs(barcodes, 'f')
+        reverse = _UniqueSeqs(barcodes, 'r')
+        design.distances['forward barcodes'] = _SetDistances(forward, maxdist)
+        design.distances['reverse barcodes'] = _SetDistances(reverse, maxdist)
+        ##the read orientation is told apart by which set hits the left window
+        design.distances['forward/reverse barcodes'] = _SetDistances(forward, maxdist, reverse)
+    design.distances['forward primers'] = _SetDistances(_UniqueSeqs(primers, 'f'), maxdist)
+    design.distances['reverse primers'] = _SetDistances(_UniqueSeqs(primers, 'r'), maxdist)
+    for setname in sorted(design.distances):
+        if(not design.exactSafe(setname, paras.MaxMisMatch)):
+            design.warnings.append("%s closer than %s edits: %s" %(setname, paras.MaxMisMatch + 1,
+                ', '.join("%s/%s" %(id1, id2) for id1, id2, dist in design.distances[setname][1]
+                          if dist <= paras.MaxMisMatch)))
+    design.barcodematcher = AhoCorasick.RefSeqMatcher(barcodes)
+    design.primermatcher = AhoCorasick.RefSeqMatcher(primers)
+    if(not symbarcode):
+        design.pairdecoder = SeqAlignParallel.PairDecoder(barcodes, paras)
+    return design
+
+def _CheckDesign(design, paras):
+    pairs = {}
+    for barcode in design.barcodes:
+        for seq in (barcode.f, barcode.r):
+            if(seq == "" or seq.strip("ACGT") != ""):
+                design.warnings.append("barcode of %s is not a plain ACGT sequence: %s" %(barcode.des, seq))
+            elif(len(seq) != paras.BarcodeLen):
+                design.warnings.append("barcode of %s is %s bp, Barcode_Length is %s" %(barcode.des, len(seq),
+                                                                                      paras.BarcodeLen))
+        pair = (barcode.f, barcode.r)
+        if(pair in pairs and pairs[pair] != barcode.des):
+            design.warnings.append("%s and %s share barcode %s, reads go to %s" %(pairs[pair], barcode.des,
+                                                                                  barcode.id, pairs[pair]))
+        pairs.setdefault(pair, barcode.des)
+    loci = set()
+    for primer in design.primers:
+        if(primer.f == "" or primer.r == ""):
+            design.warnings.append("locus %s misses a primer" %(primer.id))
+        if(primer.id in loci):
+            design.warnings.append("locus %s is listed more than once" %(primer.id))
+        loci.add(primer.id)
+
+def _UniqueSeqs(refseqs, side):
+    """[(sequence, name)] of the distinct sequences of one side in list order"""
+    seqs = {}
+    for refseq in refseqs:
+        seq = refseq.f if side == 'f' else refseq.r
+        if(seq not in seqs):
+            seqs[seq] = refseq.des
+    return list(seqs.items())
+
+def _SetDistances(seqs, maxdist, others=None):
+    """(minimum edit distance, pairs within maxdist) within seqs, or between seqs and others"""
+    if(others is None):
+        pairs = [(i, j) for i in range(len(seqs)) for j in range(i + 1, len(seqs))]
+        others = seqs
+    else:
+        pairs = [(i, j) for i in range(len(seqs)) for j in range(len(others)) if seqs[i][0] != others[j][0]]
+    if(len(pairs) == 0):
+        return (None, [])
+    mindist = None
+    closepairs = []
+    for start in range(0, len(pairs), PAIR_BLOCK):
+        block = pairs[start:start + PAIR_BLOCK]
+        dists = EditDistances([seqs[i][0] for i, j in block], [others[j][0] for i, j in block])
+        blockmin = int(dists.min())
+        mindist = blockmin if mindist is None else min(mindist, blockmin)
+        for k in np.flatnonzero(dists <= maxdist):
+            i, j = block[k]
+            closepairs.append((seqs[i][1], others[j][1], int(dists[k])))
+    return (mindist, closepairs)
+
+def EditDistances(seqsA, seqsB):
+    """Levenshtein distance of every seqsA[k], seqsB[k] pair, one numpy pass over all pairs"""
+    codesA, lensA = _Codes(seqsA)
+    codesB, lensB = _Codes(seqsB)
+    pairnum = len(seqsA)
+    lenA = codesA.shape[1]
+    lenB = codesB.shape[1]
+    dists = np.where(lensA == 0, lensB, 0)
+    prev = np.tile(np.arange(lenB + 1), (pairnum, 1))
+    for x in range(1, lenA + 1):
+        cur = np.empty_like(prev)
+        cur[:, 0] = x
+        for y in range(1, lenB + 1):
+            cur[:, y] = np.minimum(np.minimum(prev[:, y], cur[:, y-1]) + 1,
+                                   prev[:, y-1] + (codesA[:, x-1] != codesB[:, y-1]))
+        done = np.flatnonzero(lensA == x)
+        dists[done] = cur[done, lensB[done]]
+        prev = cur
+    return dists
+
+def _Codes(seqs):
+    lens = np.array([len(seq) for seq in seqs])
+    codes = np.zeros((len(seqs), max(lens.max(), 1)), dtype=np.uint8)
+    for k, seq in enumerate(seqs):
+        codes[k, :len(seq)] = np.frombuffer(seq.encode(), dtype=np.uint8)
+    return (codes, lens)
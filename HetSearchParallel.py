@@ -9,7 +9,10 @@ from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
 from scipy.stats import ttest_1samp
 #import cogent.maths.stats.test as stats
-from multiprocessing import Pool
+from time import time
+from os import getpid
+import Progress
+import RunProfile
 import re
 import sys
 import os
@@ -32,6 +35,12 @@ class HetInfo(object):
         self.gene = ""
         self.het = "" # NA,"TRUE","FALSE"
         self.hetSeqs = {}
+        self.readnum = 0
+        self.musclecalls = 0
+        self.muscletime = 0.0
+        self.busy = 0.0
+        self.worker = 0
+        self.screened = False
 
 class HetSearch(object):
     def __init__(self, projenv):
@@ -39,39 +48,65 @@ class HetSearch(object):
         self.SortedSeqs = projenv.SortedSeqs
         self.locusLengthRange = projenv.locusLengthRange
         self.msgHandle = projenv
+        self.profile = projenv.Profile
+        self.workers = projenv.Workers
+        ##(strain, gene) -> HetInfo already searched while reads were aligned
+        self.pipelined = projenv.PipelinedHet
 
         self.MinReadNum = 5
         self.MinReadRatio = 0.2
         self.MinVariantRatio = 0.2
         self.HeteroPvalue = 0.001
         self.MinHetVariants = 2
+        ##k-mer size of the pre-MSA homozygosity screen, 0 sends every bucket to MUSCLE
+        self.ScreenKmer = self.parameters.ScreenKmer
         
         self.HetSeqs = {}
         self.HetInfo = {}
 
     def Run(self):
-        self.msgHandle.showMsg ('Searching for heterozygous loci...', "")
-        pool = Pool(self.parameters.Threads)
-        from time import time
-        ##t0 = time()
+        self.msgHandle.showMsg ('Searching for heterozygous loci...')
+        pool = self.workers.pool(self.parameters.Threads)
         MUSCLE = self.parameters.MuscleCMD
-        resqueue = []
+        tasks = []
+        bucketreads = {}
+        results = []
         for strain in self.SortedSeqs:
             strainSeqs = self.SortedSeqs[strain]
             for gene in strainSeqs:
                 if(gene == "unmapped"):
                     continue
+                if((strain, gene) in self.pipelined):
+                    results.append(self.pipelined[(strain, gene)])
+                    self.profile.count('pipelined_loci')
+                    continue
+                results.append(None)
                 geneSeqs = strainSeqs[gene]
                 lenRange = self.locusLengthRange[gene]
-                #hetInfo = HetIdent(gene,strain,geneSeqs,lenRange,MUSCLE,self.MinVariantRatio,self.HeteroPvalue,self.MinReadRatio,self.MinReadNum,self.MinHetVariants)
-                poolres = pool.apply_async(HetIdent,(gene,strain,geneSeqs,lenRange,MUSCLE,self.MinVariantRatio,
-                                                     self.HeteroPvalue,self.MinReadRatio,self.MinReadNum,self.MinHetVariants))
-                resqueue.append(poolres)
-        pool.close()
-        pool.join()
-        #print ("Resqueue: %s" %(len(resqueue)))
-        for res in resqueue:
-            resinfo = res.get()
+                ##workers only get the trimmed reads in the length range, not the aligned reads
+                readseqs = HetReads(geneSeqs, lenRange, self.MinReadNum)
+                tasks.append((len(results) - 1, self.parameters.ProfileStage, gene, strain, readseqs, MUSCLE, self.MinVariantRatio,
+                              self.HeteroPvalue, self.MinReadRatio, self.MinHetVariants, self.ScreenKmer))
+                bucketreads[len(results) - 1] = len(geneSeqs)
+        listener = Progress.ProgressListener('het search', sum(bucketreads.values()), self.workers.progress,
+                                             self.msgHandle.showProgress)
+        listener.start()
+        workerbusy = {}
+        screened = len([resinfo for resinfo in results if resinfo is not None and resinfo.screened])
+        try:
+            for taskidx, resinfo, stats in pool.imap_unordered(_HetTask, tasks):
+                results[taskidx] = resinfo
+                self.profile.addWorkerStats(stats)
+                listener.post(resinfo.worker, bucketreads[taskidx])
+                self.profile.reads(resinfo.readnum)
+                self.profile.muscle(resinfo.musclecalls, resinfo.muscletime)
+                workerbusy[resinfo.worker] = workerbusy.get(resinfo.worker, 0) + resinfo.busy
+                if(resinfo.screened):
+                    screened += 1
+        finally:
+            listener.stop()
+        ##merge in submission order so the output does not depend on completion order
+        for resinfo in results:
             straininfo = {}
             hetinfo = {}            
             #print ("strain: %s, gene: %s" %(resinfo.strain, resinfo.gene))
@@ -84,34 +119,103 @@ class HetSearch(object):
                 self.HetSeqs[resinfo.strain] = straininfo
             hetinfo[resinfo.gene] = resinfo.het
             self.HetInfo[resinfo.strain] = hetinfo
-        #t1 = time()
-        #print ("Time spends %.2fs." %(t1-t0))
+        self.profile.workers(self.parameters.Threads, list(workerbusy.values()), [])
+        tested = len([resinfo for resinfo in results if resinfo.het != -1])
+        self.profile.count('screen_homozygous', screened)
+        self.profile.count('screen_ambiguous', tested - screened)
+        if(tested > 0):
+            self.msgHandle.showMsg ('%s of %s loci screened as homozygous without alignment (%.1f%%)'
+                                    %(screened, tested, 100.0 * screened / tested))
         self.msgHandle.showMsg ('done!')
         return (True, None)
 
-def HetIdent(gene, strain, geneSeqs, lenRange, MUSCLE, MinVariantRatio,
-             HeteroPvalue, MinReadRatio, MinReadNum, MinHetVariants):
-    filteredseqs = __SeqFilter(geneSeqs,lenRange,MinReadNum)
+    def bucketHet(self, strain, gene, geneSeqs, lenRange):
+        """HetInfo of one strain x locus, searched in this process"""
+        readseqs = HetReads(geneSeqs, lenRange, self.MinReadNum)
+        return HetIdent(gene, strain, readseqs, self.parameters.MuscleCMD, self.MinVariantRatio,
+                        self.HeteroPvalue, self.MinReadRatio, self.MinHetVariants, self.ScreenKmer)
+
+def HetReads(alnseqs, lenRange, minReadNum):
+    """return (read id, trimmed sequence) of the reads in the length range, "" if too few"""
+    if(len(alnseqs) < minReadNum):return ""
+    
+    seqs = []
+    for alnseq in alnseqs:
+        seqlen = alnseq.TrimmedLength()
+        if(seqlen < lenRange['s1'] or seqlen > lenRange['s2']) : continue
+        seqs.append((alnseq.seqid, alnseq.PrimerView().seq))
+        
+    if(len(seqs) < minReadNum):return ""
+    
+    return seqs
+
+def KmerScreen(seqs, k, minratio):
+    """True when the bucket is clearly homozygous by its k-mer spectrum
+
+    The most shared k-mer must be in more reads than any single allele could hold, a second
+    allele or indel in at least minratio of the reads then leaves k-mers in an allele-sized
+    share of them. Read ends are included so length variants count too. Sequencing errors
+    rarely repeat more than twice and stay below that share; buckets too small to tell an
+    allele from a repeated error are never screened.
+    """
+    counts = {}
+    for seq in seqs:
+        seq = "^" + seq.upper() + "$"
+        for kmer in set(seq[i:i+k] for i in range(len(seq) - k + 1)):
+            counts[kmer] = counts.get(kmer, 0) + 1
+    if(len(counts) == 0):
+        return False
+    top = max(counts.values())
+    low = max(top * minratio / 2, 3)
+    high = top * 0.6
+    if(top * minratio < 3 or top <= len(seqs) * (1 - minratio)):
+        return False
+    for count in counts.values():
+        if(count >= low and count <= high):
+            return False
+    return True
+
+def _HetTask(task):
+    """(task index, HetInfo, worker cProfile stats) of one (index, profile stage, HetIdent args...) task"""
+    profiler = RunProfile.WorkerProfiler(task[1])
+    profiler.start('het search')
+    try:
+        resinfo = HetIdent(*task[2:])
+    finally:
+        profiler.stop()
+    return (task[0], resinfo, profiler.stats())
+
+def HetIdent(gene, strain, readseqs, MUSCLE, MinVariantRatio,
+             HeteroPvalue, MinReadRatio, MinHetVariants, ScreenKmer=0):
+    t0 = time()
     hetinfo = HetInfo()
     hetinfo.strain = strain
     hetinfo.gene = gene
-    if(filteredseqs != ""):
-        alignSeqs = __MuscleAlignment(filteredseqs, MUSCLE)
+    hetinfo.worker = getpid()
+    if(readseqs != "" and ScreenKmer > 0 and KmerScreen([seq for seqid, seq in readseqs], ScreenKmer,
+                                                        MinVariantRatio)):
+        hetinfo.readnum = len(readseqs)
+        hetinfo.screened = True
+        hetinfo.het = 0
+    elif(readseqs != ""):
+        filteredseqs = [SeqRecord(Seq(seq,generic_dna),id=seqid,description="") for seqid, seq in readseqs]
+        hetinfo.readnum = len(filteredseqs)
+        alignSeqs = __MuscleAlignment(filteredseqs, MUSCLE, hetinfo)
         variantBases = __getVariants(alignSeqs, MinVariantRatio)
         (isHet, index) = __isHetero(variantBases, HeteroPvalue, MinReadRatio)
         if(isHet):
             (seqN1, seqN2) = __getSeqGroups(alignSeqs,index)
             seqs1 = __getSeqs(filteredseqs, seqN1)
             seqs2 = __getSeqs(filteredseqs, seqN2)
-            aligns1 = __MuscleAlignment(seqs1, MUSCLE)
-            aligns2 = __MuscleAlignment(seqs2, MUSCLE)
+            aligns1 = __MuscleAlignment(seqs1, MUSCLE, hetinfo)
+            aligns2 = __MuscleAlignment(seqs2, MUSCLE, hetinfo)
             cons1 = __AlignConsensus(aligns1)
             cons2 = __AlignConsensus(aligns2)
             gname1 = gene + "_allele1"
             gname2 = gene + "_allele2"
             seqrec1 = SeqRecord(Seq(cons1,generic_dna),id=strain,description=gname1)
             seqrec2 = SeqRecord(Seq(cons2,generic_dna),id=strain,description=gname2)
-            isIdent = __isConsIden(seqrec1,seqrec2,MUSCLE,MinHetVariants)
+            isIdent = __isConsIden(seqrec1,seqrec2,MUSCLE,MinHetVariants,hetinfo)
             if(isIdent):
                 #print ("strain:%s gene:%s not Hetero!" %(strain, gene))
                 hetinfo.het = 0
@@ -129,6 +233,7 @@ def HetIdent(gene, strain, geneSeqs, lenRange, MUSCLE, MinVariantRatio,
         #print ("strain:%s gene:%s low coverage!" %(strain, gene))
         hetinfo.het = -1
         #return (0,None)
+    hetinfo.busy = time() - t0
     return hetinfo
     
 def __isHetero(variantBases, maxpvalue, minreadratio):
@@ -153,7 +258,7 @@ def __isHetero(variantBases, maxpvalue, minreadratio):
                 return (True, scoreinfo['minindex'])
     return (False, 0)
 
-def __MuscleAlignment(sortedseqs, MUSCLE):
+def __MuscleAlignment(sortedseqs, MUSCLE, hetinfo=None):
     tmpfile = tempfile.NamedTemporaryFile('w',delete=False)
     tmpname = tmpfile.name
     for seq in sortedseqs:
@@ -161,31 +266,21 @@ def __MuscleAlignment(sortedseqs, MUSCLE):
     tmpfile.flush()
     tmpfile.close()
     cmdline = MuscleCommandline(MUSCLE,input=tmpname,gapopen=-20.0)
+    t0 = time()
     STDOUT, STDERR  = cmdline()
+    if(hetinfo is not None):
+        hetinfo.musclecalls += 1
+        hetinfo.muscletime += time() - t0
     os.remove(tmpname)
     align = AlignIO.read(StringIO(STDOUT.decode('utf-8')), "fasta")
     return align
 
-def __SeqFilter(alnseqs,lenRange,minReadNum):
-
-    if(len(alnseqs) < minReadNum):return ""
-    
-    seqs = []
-    for alnseq in alnseqs:
-        seq = alnseq.TrimPrimer()
-        if(len(seq) < lenRange['s1'] or len(seq) > lenRange['s2']) : continue
-        seqs.append(seq)
-        
-    if(len(seqs) < minReadNum):return ""
-    
-    return seqs
-
-def __isConsIden(seq1,seq2,MUSCLE,MinHetVariants):
+def __isConsIden(seq1,seq2,MUSCLE,MinHetVariants,hetinfo=None):
     NuCoding = ['A','T','C','G']
     conSeqs = []
     conSeqs.append(seq1)
     conSeqs.append(seq2)
-    align = __MuscleAlignment(conSeqs, MUSCLE)
+    align = __MuscleAlignment(conSeqs, MUSCLE, hetinfo)
     trimSeq1, trimSeq2 = __trimGap(align[0].seq, align[1].seq)
     if(str(trimSeq1) == str(trimSeq2)):
         return True
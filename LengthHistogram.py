@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+
+class LengthHistogram(object):
+    """class to store the length distribution of one locus as length -> count"""
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def __len__(self):
+        return self.total
+
+    def add(self, length, count=1):
+        if(length in self.counts):
+            self.counts[length] += count
+        else:
+            self.counts[length] = count
+        self.total += count
+
+    def merge(self, other):
+        for length in other.counts:
+            self.add(length, other.counts[length])
+
+    def inRange(self, lenRange):
+        """number of lengths within lenRange['s1']..lenRange['s2']"""
+        return sum(self.counts[length] for length in self.counts
+                   if length >= lenRange['s1'] and length <= lenRange['s2'])
+
+    def lengths(self):
+        return sorted(self.counts.keys())
+
+    def weights(self):
+        return [self.counts[length] for length in self.lengths()]
+
+    def quantile(self, fraction):
+        """length at index int(total*fraction) of the sorted length list"""
+        if(self.total == 0):
+            raise ValueError ("Error: LengthHistogram does not contain any record")
+        index = int(self.total * fraction)
+        cumcount = 0
+        for length in self.lengths():
+            cumcount += self.counts[length]
+            if(cumcount > index):
+                return length
+        return self.lengths()[-1]
+
+    def lengthRange(self, whiskerfold=2):
+        q1 = self.quantile(0.25)
+        q3 = self.quantile(0.75)
+        whisker = whiskerfold * (q3 - q1)
+        return {'s1':q1 - whisker, 's2':q3 + whisker}
+
+
+def MergeHistograms(target, hists):
+    """merge gene -> LengthHistogram dicts into target"""
+    for gene in hists:
+        if(gene in target):
+            target[gene].merge(hists[gene])
+        else:
+            hist = LengthHistogram()
+            hist.merge(hists[gene])
+            target[gene] = hist
+    return target
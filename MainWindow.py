@@ -18,6 +18,8 @@ import ProjMergeDlg
 import Parameters
 import DataViewer
 import ProjectEnviroment
+import LengthHistogram
+import WorkerPool
 import AboutDlg
 
 __version__ = "0.2.0"
@@ -25,6 +27,7 @@ __version__ = "0.2.0"
 
 class MainWindow(QMainWindow):
     runinfo = pyqtSignal(object, object)
+    runprogress = pyqtSignal(object)
 
     def __init__(self, parent=None):
         ##------------
@@ -62,6 +65,7 @@ class MainWindow(QMainWindow):
         # --connections---------
         self.paraTree.itemSelectionChanged.connect(self.treeselectionChanged)
         self.runinfo.connect(self.runinfohandle)
+        self.runprogress.connect(self.runprogresshandle)
 
         ##--actions--------
 
@@ -130,7 +134,7 @@ class MainWindow(QMainWindow):
         self.toolbar.addAction(self.projSetupAction)
         self.toolbar.addSeparator()
         self.toolbar.addAction(self.projRunAction)
-        # self.toolbar.addAction(self.projStopAction)
+        self.toolbar.addAction(self.projStopAction)
 
         # --------self status-----
         self.projenv = None
@@ -221,6 +225,7 @@ class MainWindow(QMainWindow):
         settings.setValue("MainWindow/Position", QVariant(self.pos()))
         # settings.setValue("MainWindow/State", QVariant(self.saveState()))
         self.__saveParatoSettings()
+        WorkerPool.SessionPool().close()
 
     def createAction(self, text, slot=None, shortcut=None, icon=None, tip=None, checkable=False,
                      signal="triggered()"):
@@ -339,20 +344,28 @@ class MainWindow(QMainWindow):
                                     ("Cannot file project information"),
                                     QMessageBox.Ok | QMessageBox.Default)
                 return
-            self.projenv = ProjectEnviroment.ProjectEnviroment(self.parameters, self.runinfo)
+            self.projenv = ProjectEnviroment.ProjectEnviroment(self.parameters, self.runinfo,
+                                                                 self.runprogress)
             try:
                 fh = gzip.open(projfile, "rb")
                 projinfo = pickle.loads(fh.read())
                 fh.close()
                 self.projenv.parameters = projinfo['parameters']
                 self.projenv.Seqs = projinfo['Seqs']
+                if 'SeqQuals' in projinfo:
+                    self.projenv.SeqQuals = projinfo['SeqQuals']
+                else:
+                    self.projenv.SeqQuals = ProjectEnviroment.ReadQualities(self.projenv.Seqs)
                 self.projenv.Primers = projinfo['Primers']
                 self.projenv.Barcodes = projinfo['Barcodes']
                 self.projenv.AlignedSeqs = projinfo['AlignedSeqs']
                 self.projenv.SortedSeqs = projinfo['SortedSeqs']
+                if 'CappedReads' in projinfo:
+                    self.projenv.CappedReads = projinfo['CappedReads']
                 self.projenv.locusLengthRange = projinfo['locusLengthRange']
                 self.projenv.consSeqs = projinfo['consSeqs']
                 self.projenv.locusLengthsInfo = projinfo['locusLengthsInfo']
+                self.projenv.num_filtered = projinfo.get('num_filtered', 0)
                 self.projenv.num_unbarcode = projinfo['num_unbarcode']
                 self.projenv.num_unprimer = projinfo['num_unprimer']
                 self.projenv.StrainStats = projinfo['StrainStats']
@@ -394,14 +407,26 @@ class MainWindow(QMainWindow):
             projFiles = projMergeDlg.projFiles
             projName = projMergeDlg.projName
             projFolder = projMergeDlg.outFolder
-            self.projenv = ProjectEnviroment.ProjectEnviroment(self.parameters, self.runinfo)
+            self.projenv = ProjectEnviroment.ProjectEnviroment(self.parameters, self.runinfo,
+                                                                 self.runprogress)
             for projfile in projFiles:
                 projinfo = pickle.load(open(projfile, "rb"))
                 self.projenv.parameters = projinfo['parameters']
+                seqoffset = len(self.projenv.Seqs)
+                for alignedseq in projinfo['AlignedSeqs']:
+                    if getattr(alignedseq, 'seqidx', -1) >= 0:
+                        alignedseq.seqidx += seqoffset
+                if 'SeqQuals' in projinfo:
+                    self.projenv.SeqQuals.extend(projinfo['SeqQuals'])
+                else:
+                    self.projenv.SeqQuals.extend(ProjectEnviroment.ReadQualities(projinfo['Seqs']))
                 self.projenv.Seqs += projinfo['Seqs']
                 self.projenv.Primers += projinfo['Primers']
                 self.projenv.Barcodes += projinfo['Barcodes']
                 self.projenv.AlignedSeqs += projinfo['AlignedSeqs']
+                if 'CappedReads' in projinfo:
+                    LengthHistogram.MergeHistograms(self.projenv.CappedReads, projinfo['CappedReads'])
+                self.projenv.num_filtered += projinfo.get('num_filtered', 0)
                 self.projenv.num_unbarcode += projinfo['num_unbarcode']
                 self.projenv.num_unprimer += projinfo['num_unprimer']
             self.projenv.parameters.ProjectName = projName
@@ -429,7 +454,8 @@ class MainWindow(QMainWindow):
 
     def projRun(self):
         if (self.projenv is None):
-            self.projenv = ProjectEnviroment.ProjectEnviroment(self.parameters, self.runinfo)
+            self.projenv = ProjectEnviroment.ProjectEnviroment(self.parameters, self.runinfo,
+                                                                 self.runprogress)
         self.threadpool = []
         compRuncode = ~ self.curRuncode
         needRun = self.jobcode & compRuncode
@@ -437,13 +463,19 @@ class MainWindow(QMainWindow):
         runproj = ProjectThread(self, needRun)
         self.threadpool.append(runproj)
         runproj.jobstats.connect(self.jobstats)
+        runproj.finished.connect(self.projFinished)
         # self.connect(runproj, SIGNAL("JobDone"), self.jobstats)
         runproj.start()
         self.__btnrunStat()
 
     def projStop(self):
-        # if(self.projenv.ismultirun):
-        #    self.projenv.alignStop()
+        if (self.projenv is not None and self.projenv.ismultirun):
+            ##finished read chunks are kept and reused by the next run, the thread ends on its own
+            for thread in self.threadpool:
+                thread.stopped = True
+            self.projenv.alignStop()
+            self.showMsg("Stopping the alignment...")
+            return
         for thread in self.threadpool:
             if (thread.isRunning()):
                 thread.terminate()
@@ -452,6 +484,11 @@ class MainWindow(QMainWindow):
         self.__btnconfigStat()
         self.showMsg("Running job has been terminated!")
 
+    def projFinished(self):
+        self.threadpool = [thread for thread in self.threadpool if thread.isRunning()]
+        if (len(self.threadpool) == 0):
+            self.__btnconfigStat()
+
     def projSetup(self):
         confDlg = ProgConfigDlg.ProgConfigDlg(self.curRuncode)
         confDlg.setWindowTitle("Job settings...")
@@ -486,12 +523,15 @@ class MainWindow(QMainWindow):
         projinfo = {}
         projinfo['parameters'] = self.projenv.parameters
         projinfo['Seqs'] = self.projenv.Seqs
+        projinfo['SeqQuals'] = self.projenv.SeqQuals
         projinfo['Primers'] = self.projenv.Primers
         projinfo['Barcodes'] = self.projenv.Barcodes
         projinfo['AlignedSeqs'] = self.projenv.AlignedSeqs
         projinfo['SortedSeqs'] = self.projenv.SortedSeqs
+        projinfo['CappedReads'] = self.projenv.CappedReads
         projinfo['locusLengthRange'] = self.projenv.locusLengthRange
         projinfo['consSeqs'] = self.projenv.consSeqs
+        projinfo['num_filtered'] = self.projenv.num_filtered
         projinfo['num_unbarcode'] = self.projenv.num_unbarcode
         projinfo['num_unprimer'] = self.projenv.num_unprimer
         projinfo['locusLengthsInfo'] = self.projenv.locusLengthsInfo
@@ -503,12 +543,13 @@ class MainWindow(QMainWindow):
 
         infofile = self.projenv.parameters.Out_Folder + "/" + self.PROJECTFILE
         try:
-            fh = gzip.open(infofile, "wb")
-            pickle.dump(projinfo, fh)
+            with gzip.open(infofile, "wb") as fh:
+                pickle.dump(projinfo, fh)
         except Exception as e:
             QMessageBox.warning(self.mainframe, "Error", ("Error: %s" % e),
                                 QMessageBox.Ok | QMessageBox.Default)
-        return
+            return False
+        return True
 
     def runinfohandle(self, msg, end):
         if (end is None):
@@ -516,6 +557,11 @@ class MainWindow(QMainWindow):
         else:
             self.showMsg(msg, end)
 
+    def runprogresshandle(self, info):
+        self.status.showMessage(info.text())
+        if (info.finished):
+            self.showMsg(info.text())
+
     def jobstats(self, statcode, msg):
         if statcode == 1:
             if msg == "Loaded":
@@ -530,6 +576,11 @@ class MainWindow(QMainWindow):
             if msg == "Done":
                 self.__btnconfigStat()
                 QMessageBox.information(self, "Job finished", "All jobs have finished!")
+        elif statcode == 0:
+            QMessageBox.warning(self, "Error", ("Error: %s" % msg),
+                                QMessageBox.Ok | QMessageBox.Default)
+        elif statcode == 2:
+            self.showMsg(msg)
         # print data
         # self.list_widget.addItem(unicode(data))
 
@@ -607,7 +658,9 @@ class MainWindow(QMainWindow):
         self.__addViewer(statsview, "Reads stats")
 
         # ---update infoview
-        infotext = ("\nBarcode Alignment: %s/%s reads have barcodes aligned\n\n"
+        infotext = ("\nRead Filter: %s/%s reads removed before alignment\n"
+                    % (self.projenv.num_filtered, readcount + self.projenv.num_filtered))
+        infotext += ("\nBarcode Alignment: %s/%s reads have barcodes aligned\n\n"
                     % (barcodealigned, readcount))
         infotext += ("Primer Alignment: %s/%s reads have primers aligned"
                      % (barcodealigned - unprimer, barcodealigned))
@@ -653,13 +706,17 @@ class ProjectThread(QThread):
     def __init__(self, mainframe, jobcode):
         QThread.__init__(self)
         self.jobcode = jobcode
+        self.stopped = False
         self.mainframe = mainframe
         self.projenv = mainframe.projenv
 
     def run(self):
         # self.projenv.msgHandle.showMsg("Start running program...")
         self.projenv.showMsg("Start running program...")
-        # t0 = time()
+        isokay, error = self.projenv.resetProfile()
+        if not isokay:
+            self.jobstats.emit(0, str(error))
+            return
         module0 = [self.__proj_loadFiles, self.__proj_alignSeqs]
         module1 = [self.__proj__genCons]
         module2 = [self.projenv.DumpUnmappedReads]
@@ -673,11 +730,18 @@ class ProjectThread(QThread):
                     isokay, error = job()
                     if not isokay:
                         # print ("Error: %s" %error)
-                        QMessageBox.warning(self.mainframe, "Error", ("Error: %s" % error),
-                                            QMessageBox.Ok | QMessageBox.Default)
+                        ##widgets belong to the GUI thread, errors and stops are reported by signal
+                        if self.stopped:
+                            self.jobstats.emit(2, str(error))
+                        else:
+                            self.jobstats.emit(0, str(error))
+                        self.projenv.writeProfile()
                         return
                 self.mainframe.curRuncode = self.mainframe.curRuncode + (1 << i)
-        self.mainframe.saveStats()
+        self.projenv.writeProfile()
+        ##the chunk checkpoints only matter until the project file holds the alignment
+        if self.mainframe.saveStats():
+            self.projenv.clearAlignCheckpoint()
         print("Done")
         self.jobstats.emit(1, "Done")
 
@@ -692,6 +756,14 @@ class ProjectThread(QThread):
 
     def __proj_alignSeqs(self):
         if not (self.projenv.status & (1 << 2)):
+            if self.projenv.parameters.PipelineStages:
+                ##start consensus/het of settled buckets while the remaining reads are aligned
+                consensus = bool(self.jobcode & (1 << 1)) and not (self.projenv.status & (1 << 4))
+                hetsearch = bool(self.jobcode & (1 << 3))
+                if consensus or hetsearch:
+                    isokay, error = self.projenv.startPipeline(consensus, hetsearch)
+                    if not isokay:
+                        return (False, error)
             isokay, error = self.projenv.alignSeqs()
             if (isokay):
                 self.projenv.locusLengths()
@@ -9,6 +9,7 @@ class Parameters(object):
         self.Out_Folder = ""
         self.Primer_File = ""
         self.Barcode_File = ""
+        self.Reference_File = ""
         self.Filetype = "FASTQ"
         self.MuscleCMD = ""
         self.ScoringSys = "phred33"
@@ -27,8 +28,27 @@ class Parameters(object):
         self.Threads = 1
         #self.ConsensusCut = 0.5
         self.EndLength = 0
+        self.ProfileStage = ""
+        self.AlignChunkSize = 5000
+        self.DedupReads = False
+        self.WindowCacheSize = 50000
+        self.BandedAlign = True
+        self.ConsensusMode = "msa"
+        self.PipelineStages = False
+        self.PipelineDepth = 3
+        self.CoverageCap = 0
+        self.MinReadLength = 0
+        self.MaxReadLength = 0
+        self.MinMeanQuality = 0
+        self.DesignCache = True
+        self.ScreenKmer = 11
 
     
+    def __setstate__(self, state):
+        ##parameters pickled by older versions miss the newer settings
+        self.__init__()
+        self.__dict__.update(state)
+    
     def update(self):
         self.PadLength = len(self.PadSeq)
         self.UniLength = len(self.UniPrimer)
@@ -52,6 +72,7 @@ class Parameters(object):
         config.set('FILES', 'Output_Folder', self.Out_Folder)
         config.set('FILES', 'Primer_File', self.Primer_File)
         config.set('FILES', 'Barcode_File', self.Barcode_File)
+        config.set('FILES', 'Reference_File', self.Reference_File)
         config.add_section('SETTINGS')
         config.set('SETTINGS', 'File_Type', self.Filetype)
         config.set('SETTINGS', 'Muscle_Command', self.MuscleCMD)
@@ -67,6 +88,20 @@ class Parameters(object):
         config.set('SETTINGS', 'Gap_Score', self.GapScore)
         config.set('SETTINGS', 'Max_Mismatch', self.MaxMisMatch)
         config.set('SETTINGS', 'Threads', self.Threads)
+        config.set('SETTINGS', 'Profile_Stage', self.ProfileStage)
+        config.set('SETTINGS', 'Align_Chunk_Size', self.AlignChunkSize)
+        config.set('SETTINGS', 'Dedup_Reads', self.DedupReads)
+        config.set('SETTINGS', 'Window_Cache_Size', self.WindowCacheSize)
+        config.set('SETTINGS', 'Banded_Align', self.BandedAlign)
+        config.set('SETTINGS', 'Consensus_Mode', self.ConsensusMode)
+        config.set('SETTINGS', 'Pipeline_Stages', self.PipelineStages)
+        config.set('SETTINGS', 'Pipeline_Depth', self.PipelineDepth)
+        config.set('SETTINGS', 'Coverage_Cap', self.CoverageCap)
+        config.set('SETTINGS', 'Min_ReadLength', self.MinReadLength)
+        config.set('SETTINGS', 'Max_ReadLength', self.MaxReadLength)
+        config.set('SETTINGS', 'Min_MeanQuality', self.MinMeanQuality)
+        config.set('SETTINGS', 'Design_Cache', self.DesignCache)
+        config.set('SETTINGS', 'Screen_Kmer', self.ScreenKmer)
         #config.set('SETTINGS', 'Consensus_Cut', self.ConsensusCut)
         
         try:
@@ -119,6 +154,7 @@ class Parameters(object):
             self.Out_Folder = config.get('FILES','Output_Folder','output')
             self.Primer_File = config.get('FILES','Primer_File','primers')
             self.Barcode_File = config.get('FILES','Barcode_File','barcodes')
+            self.Reference_File = config.get('FILES','Reference_File',fallback='')
             self.Filetype = config.get('SETTINGS','File_Type','FASTQ')
             self.Filetype = self.Filetype.upper()
             self.MuscleCMD = config.get('SETTINGS','Muscle_Command','muscle')
@@ -138,6 +174,20 @@ class Parameters(object):
             self.GapScore = int(config.get('SETTINGS','Gap_Score','-1'))
             self.MaxMisMatch = int(config.get('SETTINGS','Max_Mismatch','3'))
             self.Threads = int(config.get('SETTINGS','Threads','1'))
+            self.ProfileStage = config.get('SETTINGS','Profile_Stage',fallback='')
+            self.AlignChunkSize = int(config.get('SETTINGS','Align_Chunk_Size',fallback='5000'))
+            self.DedupReads = config.getboolean('SETTINGS','Dedup_Reads',fallback=False)
+            self.WindowCacheSize = int(config.get('SETTINGS','Window_Cache_Size',fallback='50000'))
+            self.BandedAlign = config.getboolean('SETTINGS','Banded_Align',fallback=True)
+            self.ConsensusMode = config.get('SETTINGS','Consensus_Mode',fallback='msa').lower()
+            self.PipelineStages = config.getboolean('SETTINGS','Pipeline_Stages',fallback=False)
+            self.PipelineDepth = int(config.get('SETTINGS','Pipeline_Depth',fallback='3'))
+            self.CoverageCap = int(config.get('SETTINGS','Coverage_Cap',fallback='0'))
+            self.MinReadLength = int(config.get('SETTINGS','Min_ReadLength',fallback='0'))
+            self.MaxReadLength = int(config.get('SETTINGS','Max_ReadLength',fallback='0'))
+            self.MinMeanQuality = float(config.get('SETTINGS','Min_MeanQuality',fallback='0'))
+            self.DesignCache = config.getboolean('SETTINGS','Design_Cache',fallback=True)
+            self.ScreenKmer = int(config.get('SETTINGS','Screen_Kmer',fallback='11'))
             #self.ConsensusCut = float(config.get('SETTINGS','Consensus_Cut','0.5'))
             self.EndLength = self.PadLength + self.BarcodeLen + self.FlankingLength
             
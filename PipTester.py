@@ -9,12 +9,18 @@ def FileModule():
     parameter = Parameters.Parameters()
     parameter.openfile("config.ini")
     parameter.update()
-    projEnv = ProjectEnviroment.ProjectEnviroment(parameter)
+    projEnv = ProjectEnviroment.ProjectEnviroment(parameter, None)
+    isokay, error = projEnv.resetProfile()
+    if(not isokay):
+        print(("Error: %s" %error))
+        return
     projEnv.loadFiles()
     barcodes = projEnv.Barcodes
     primers = projEnv.Primers
     seqs = projEnv.Seqs
     t0 = time()
+    if(parameter.PipelineStages):
+        projEnv.startPipeline(True, False)
     projEnv.alignSeqs()
     alignseqs = projEnv.AlignedSeqs
     print ("Sort sequencing...")
@@ -35,6 +41,8 @@ def FileModule():
     projEnv.DumpUnmappedReads()
     t1 = time()
     print(("Time spends %.2fs." %(t1-t0)))
+    projEnv.writeProfile()
+    projEnv.closeWorkers()
 
 
 if(__name__ == '__main__'):
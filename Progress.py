@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+from itertools import count
+from threading import Thread
+from time import time
+
+##listener ids, events of an earlier listener still in the queue are told apart by them
+_runids = count(1)
+
+
+class ProgressInfo(object):
+    """class to store a progress snapshot of one stage"""
+    def __init__(self, stage, done, total, elapsed, workers, finished=False):
+        self.stage = stage
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.workers = workers
+        self.finished = finished
+
+    def rate(self):
+        if(self.elapsed <= 0):
+            return 0.0
+        return self.done / self.elapsed
+
+    def eta(self):
+        rate = self.rate()
+        if(rate <= 0 or self.total <= 0):
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def text(self):
+        msg = "%s: %s/%s reads, %.0f reads/s" % (self.stage, self.done, self.total, self.rate())
+        eta = self.eta()
+        if(self.finished):
+            msg += ", done in %.1fs" % (self.elapsed)
+        elif(eta is not None):
+            msg += ", ETA %.0fs" % (eta)
+        if(len(self.workers) > 1):
+            msg += " [" + " ".join(str(self.workers[i]) for i in sorted(self.workers)) + "]"
+        return msg
+
+
+class ProgressListener(object):
+    """class to collect (runid, workerid, count) events from worker processes in a background thread
+
+    Workers report through WorkerProgress with the listener's runid. The queue is shared by
+    the stages of a session, so events a previous stage's workers flushed late are dropped.
+    """
+    def __init__(self, stage, total, queue, callback, interval=0.5):
+        self.runid = next(_runids)
+        self.stage = stage
+        self.total = total
+        self.queue = queue
+        self.callback = callback
+        self.interval = interval
+        self.done = 0
+        self.workers = {}
+        self._t0 = 0.0
+        self._thread = None
+
+    def start(self):
+        self._t0 = time()
+        self._thread = Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def post(self, workerid, count):
+        """report processed reads from this process"""
+        self.queue.put((self.runid, workerid, count))
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+        self.callback(self.snapshot(finished=True))
+
+    def snapshot(self, finished=False):
+        return ProgressInfo(self.stage, self.done, self.total, time() - self._t0,
+                            dict(self.workers), finished)
+
+    def _listen(self):
+        lastreport = 0.0
+        while True:
+            event = self.queue.get()
+            if(event is None):
+                break
+            runid, workerid, count = event
+            if(runid != self.runid):
+                continue
+            self.done += count
+            self.workers[workerid] = self.workers.get(workerid, 0) + count
+            now = time()
+            if(now - lastreport >= self.interval):
+                lastreport = now
+                self.callback(self.snapshot())
+
+
+def WorkerProgress(queue, workerid, runid, step=100):
+    """return a function reporting processed reads of listener runid to queue every step reads"""
+    state = {'pending':0}
+    def report(count=1, flush=False):
+        state['pending'] += count
+        if(state['pending'] >= step or (flush and state['pending'] > 0)):
+            queue.put((runid, workerid, state['pending']))
+            state['pending'] = 0
+    return report
@@ -1,7 +1,16 @@
 import csv
+from array import array
+import AlignCheckpoint
 import SeqAlignParallel
 import ConsensusSeqs
 import HetSearchParallel
+import LengthHistogram
+import ReadFilter
+import RunProfile
+import SeqFileReader
+import WorkerPool
+import BucketPipeline
+import DesignCache
 import sys
 
 from Bio import SeqIO
@@ -20,12 +29,15 @@ class Primer(object):
 
 class ProjectEnviroment(object):
     
-    def __init__(self, parameters, msgHandle):
+    def __init__(self, parameters, msgHandle, progressHandle=None):
         self.parameters = parameters
         self.msgHandle = msgHandle
+        self.progressHandle = progressHandle
         self.Seqs = []
+        self.SeqQuals = array('f')
         self.Barcodes = []
         self.Primers = []
+        self.References = {}
         self.AlignedSeqs = []
         self.SortedSeqs = {}
         self.locusLengthRange = {}
@@ -35,25 +47,50 @@ class ProjectEnviroment(object):
         self.status = 0
         self.ismultirun = 0
         self.locusLengthsInfo = None
+        self.LocusLengthHists = {}
+        ##(strain, gene) -> LengthHistogram of reads over the coverage cap, counted but not kept
+        self.CappedReads = {}
+        self.num_filtered = 0
+        self.FilterCounts = {}
         self.num_unbarcode = 0
         self.num_unprimer = 0
         self.StrainStats = None
         self.HetStats = None
         self.SymBarcode = True
+        self.Design = None
+        self.Profile = RunProfile.RunProfile()
+        self.Workers = WorkerPool.SessionPool()
+        self.Pipeline = None
+        self.PipelinedCons = {}
+        self.PipelinedHet = {}
 
+    @RunProfile.ProfiledStage('load')
     def loadFiles(self):
-        isokay, errMsg = self.__readBarcodes()
-        if(not isokay):
-            return (False, errMsg)
-        isokay, errMsg = self.__readPrimers()
+        isokay, errMsg = self.__loadDesign()
         if(not isokay):
             return (False, errMsg)
         isokay, errMsg = self.__readSeqs()
         if(not isokay):
             return (False, errMsg)
+        self.Profile.reads(len(self.Seqs))
+        self.filterReads()
         self.status = 1
         return (True, None)
 
+    def filterReads(self):
+        """drop reads out of the length and mean quality limits before the barcode search"""
+        ##runs inside the load stage, its counters are recorded there
+        keepidxs, counts = ReadFilter.ReadFilter(self.parameters).run(self.Seqs, self.SeqQuals)
+        self.FilterCounts = counts
+        self.num_filtered = len(self.Seqs) - len(keepidxs)
+        for reason in counts:
+            self.Profile.count('filtered_' + reason, counts[reason])
+        if(self.num_filtered > 0):
+            self.Seqs = [self.Seqs[seqidx] for seqidx in keepidxs]
+            self.SeqQuals = array('f', [self.SeqQuals[seqidx] for seqidx in keepidxs])
+            self.showMsg('%s reads removed by the read filter' %(self.num_filtered))
+        return (True, None)
+
     def numprimers(self):
         return len(self.Primers)
     
@@ -79,32 +116,93 @@ class ProjectEnviroment(object):
         #    self.msgHandle.showMsg('Loading sequences...', end="")
 
         Seqs = []
-        for file in files:
-            try: 
-                handle = open(file,'rU')
-                if(filetype == "FASTA"):
-                    for seq in SeqIO.parse(handle,"fasta"):
-                        seq = seq.upper()
-                        seqlen = len(seq)
-                        quality = [50] * seqlen
-                        seq.letter_annotations["phred_quality"] = quality
-                        Seqs.append(seq)
-                else:
-                    if(scoretype == "phred33"):
-                        for seq in SeqIO.parse(handle,"fastq-sanger"):
+        SeqQuals = array('f')
+        try:
+            tasks = SeqFileReader.SeqFileTasks(files, filetype, scoretype)
+        except Exception as e:
+            return (False, e)
+        if(self.parameters.Threads > 1 and len(tasks) > 1):
+            ##byte ranges and files are parsed side by side, imap keeps the file and record order
+            try:
+                pool = self.Workers.pool(self.parameters.Threads)
+                for seqs, quals in pool.imap(SeqFileReader.ParseSeqTask, tasks):
+                    Seqs += seqs
+                    SeqQuals.extend(quals)
+            except Exception as e:
+                return (False, e)
+        else:
+            for file in files:
+                try: 
+                    handle = SeqFileReader.OpenSeqFile(file, self.parameters.Threads)
+                    if(filetype == "FASTA"):
+                        for seq in SeqIO.parse(handle,"fasta"):
                             seq = seq.upper()
+                            seqlen = len(seq)
+                            quality = [50] * seqlen
+                            seq.letter_annotations["phred_quality"] = quality
                             Seqs.append(seq)
+                            SeqQuals.append(50)
                     else:
-                        for seq in SeqIO.parse(handle,"fastq-solexa"):
-                            seq = seq.upper()
-                            Seqs.append(seq)
-            except Exception as e:
-                return (False, e)
+                        if(scoretype == "phred33"):
+                            for seq in SeqIO.parse(handle,"fastq-sanger"):
+                                seq = seq.upper()
+                                Seqs.append(seq)
+                                SeqQuals.append(MeanQuality(seq))
+                        else:
+                            for seq in SeqIO.parse(handle,"fastq-solexa"):
+                                seq = seq.upper()
+                                Seqs.append(seq)
+                                SeqQuals.append(MeanQuality(seq))
+                    handle.close()
+                except Exception as e:
+                    return (False, e)
         self.showMsg('done!')
         #if(self.msgHandle is not None):                
         #    self.msgHandle.showMsg('done!')
         
         self.Seqs = Seqs
+        self.SeqQuals = SeqQuals
+        return (True, None)
+
+    def __loadDesign(self):
+        """barcodes and primers from the compiled design of the plate layout, compiled on first use"""
+        self.Design = None
+        if(not self.parameters.DesignCache):
+            isokay, errMsg = self.__readBarcodes()
+            if(not isokay):
+                return (False, errMsg)
+            return self.__readPrimers()
+        try:
+            key = DesignCache.DesignKey(self.parameters)
+        except Exception as e:
+            return (False, e)
+        design = DesignCache.LoadDesign(key)
+        if(design is not None):
+            self.showMsg('Loading compiled design %s...done!' %(key[:12]))
+            self.Barcodes = design.barcodes
+            self.Primers = design.primers
+            self.SymBarcode = design.symbarcode
+            self.Design = design
+            return (True, None)
+        isokay, errMsg = self.__readBarcodes()
+        if(not isokay):
+            return (False, errMsg)
+        isokay, errMsg = self.__readPrimers()
+        if(not isokay):
+            return (False, errMsg)
+        self.showMsg('Compiling design...', end="")
+        design = DesignCache.CompileDesign(key, self.Barcodes, self.Primers, self.SymBarcode, self.parameters)
+        self.showMsg('done!')
+        for line in design.summary(self.parameters.MaxMisMatch):
+            self.showMsg(line)
+        for warning in design.warnings:
+            self.showMsg('Warning: %s' %(warning))
+        try:
+            DesignCache.SaveDesign(design)
+        except Exception as e:
+            ##a read-only home only costs the compilation next time
+            self.showMsg('Compiled design was not saved: %s' %(e))
+        self.Design = design
         return (True, None)
 
     def __readPrimers(self):
@@ -136,6 +234,23 @@ class ProjectEnviroment(object):
         self.Primers = primers 
         return (True, None)
         
+    def __readReferences(self):
+        ##locus references come from the reference FASTA, or else the 4th column of the primer file
+        references = {}
+        try:
+            if(self.parameters.Reference_File != ""):
+                for record in SeqIO.parse(self.parameters.Reference_File, "fasta"):
+                    references[record.id.replace(' ','.')] = str(record.seq).upper()
+            else:
+                with open(self.parameters.Primer_File, newline='') as csv_primer:
+                    for line in csv.reader(csv_primer):
+                        if(len(line) > 3 and line[3].strip() != ""):
+                            references[line[0].strip().replace(' ','.')] = line[3].strip().upper()
+        except Exception as e:
+            return (False, e)
+        self.References = references
+        return (True, None)
+        
     def __readBarcodes(self):
         Barcodes = []
         barcodefile = self.parameters.Barcode_File
@@ -169,8 +284,11 @@ class ProjectEnviroment(object):
                         Barcode = Primer(barcode,barcode,minscore,minscore,barcode,species)
                     else:
                         barcodeR = line[2].strip()
-                        barcodeR = barcode.upper()
-                        Barcode = Primer(barcode,barcodeR,minscore,minscore,barcode,species)
+                        barcodeR = barcodeR.upper()
+                        minscoreR = (len(barcodeR) - self.parameters.MaxMisMatch) * self.parameters.MatchScore + \
+                        max(self.parameters.GapScore,self.parameters.MismatchScore) * self.parameters.MaxMisMatch
+                        ##forward barcodes are shared by several pairs on combinatorial plates
+                        Barcode = Primer(barcode,barcodeR,minscore,minscoreR,barcode + '-' + barcodeR,species)
                     Barcodes.append(Barcode)
 
         except Exception as e:
@@ -181,24 +299,58 @@ class ProjectEnviroment(object):
         self.Barcodes = Barcodes
         return (True, None)
     
+    def startPipeline(self, consensus, hetsearch):
+        """build consensus and/or search heterozygosity of ready buckets during the next alignSeqs"""
+        self.References = {}
+        if(consensus and self.parameters.ConsensusMode == "reference"):
+            isokay, error = self.__readReferences()
+            if(not isokay):
+                return (False, error)
+        self.Pipeline = BucketPipeline.BucketPipeline(self, consensus, hetsearch)
+        self.Pipeline.start()
+        return (True, None)
+    
     def alignSeqs(self):
+        self.PipelinedCons = {}
+        self.PipelinedHet = {}
         self.Aligns = SeqAlignParallel.SeqAlignments(self)
         self.ismultirun = 1
-        self.Aligns.Run()
+        isokay, error = self.Aligns.Run()
         #self.Aligns.AlignBarcodes()
         #self.Aligns.AlignPrimers()
         self.ismultirun = 0
+        if(self.Pipeline is not None):
+            pipeline = self.Pipeline
+            self.Pipeline = None
+            pipeisokay, pipeerror = pipeline.finish()
+            if(isokay and not pipeisokay):
+                isokay, error = (False, pipeerror)
+            if(isokay):
+                self.PipelinedCons = pipeline.ConsSeqs if pipeline.consensus else {}
+                self.PipelinedHet = pipeline.HetInfo if pipeline.hetsearch else {}
+        if(not isokay):
+            self.Aligns = None
+            return (False, error)
         self.AlignedSeqs = self.Aligns.alignedseqs
         self.num_unbarcode = self.Aligns.num_unbarcode
         self.num_unprimer = self.Aligns.num_unprimer
+        self.LocusLengthHists = self.Aligns.lengthhists
+        self.CappedReads = self.Aligns.cappedreads
         self.status = self.status + (1<<2)
         self.Aligns = None
         return (True, None)
     
+    def clearAlignCheckpoint(self):
+        """drop the per-chunk alignment results once a finished alignment has been saved"""
+        if(self.status & (1 << 2)):
+            AlignCheckpoint.AlignCheckpoint(AlignCheckpoint.CheckpointFolder(self.parameters.Out_Folder),
+                                            None).remove()
+
     def alignStop(self):
-        self.Aligns.Stop()
-        self.Aligns = None
+        if(self.Aligns is not None):
+            self.Aligns.Stop()
     
+    @RunProfile.ProfiledStage('sort')
     def sortAlignedSeqs(self):
         self.showMsg('Sorting the aligned reads by barcodes and primers...', end="")
         #if(self.msgHandle is not None):
@@ -226,52 +378,35 @@ class ProjectEnviroment(object):
         self.showMsg('done!')
         #if(self.msgHandle is not None):
         #    self.msgHandle.showMsg('done!')
+        self.Profile.reads(len(self.AlignedSeqs))
         self.status = self.status + (1<<3)
         return (True, None)
         
+    @RunProfile.ProfiledStage('lengths')
     def locusLengths(self):
         self.showMsg('Calculate length distribution of each locus...', end="")
-        locuslens = {}
-        for seq in self.AlignedSeqs:
-            if(seq.gene == ""):continue
-            if(seq.gene in locuslens):
-                tmplengths = locuslens[seq.gene]
-                tmplengths.append(seq.LocusLength())
-            else:
-                tmplengths = []
-                tmplengths.append(seq.LocusLength())
-                locuslens[seq.gene] = tmplengths
+        locushists = self.LocusLengthHists
+        if(len(locushists) == 0):
+            ##histograms are filled during primer search, rebuild them for merged projects
+            for seq in self.AlignedSeqs:
+                if(seq.gene == ""):continue
+                if(seq.gene not in locushists):
+                    locushists[seq.gene] = LengthHistogram.LengthHistogram()
+                locushists[seq.gene].add(seq.LocusLength())
+            self.LocusLengthHists = locushists
         
+        locusname = sorted(list(locushists.keys()))
         locuslenList = []
-        locusname = sorted(list(locuslens.keys()))
         for loci in locusname:
-            locuslenList.append(locuslens[loci])
+            locuslenList.append(locushists[loci])
         
         self.locusLengthsInfo = {}
         self.locusLengthsInfo['name'] = locusname
         self.locusLengthsInfo['data'] = locuslenList
                 
         locusRange = {}
-        #lendiver = 0.05
-        for gene in locuslens:
-            lengths = locuslens[gene]
-            totallength = 0
-            #for i in lengths:
-            #    totallength += i
-            #meanlength = totallength/len(lengths)
-            #s1 = meanlength * (1 - lendiver)
-            #s2 = meanlength * (1 + lendiver)
-            sortedlength = sorted(lengths)
-            listlen = len(lengths)
-            q1 = sortedlength[int(listlen*0.25)]
-            q3 = sortedlength[int(listlen*0.75)]
-            iqd = q3-q1
-            #whisker = 1.5*iqd
-            whisker = 2*iqd
-            s1 = q1 - whisker
-            s2 = q3 + whisker
-            lenRange = {'s1':s1,'s2':s2}
-            locusRange[gene] = lenRange
+        for gene in locushists:
+            locusRange[gene] = locushists[gene].lengthRange()
             
         self.locusLengthRange = locusRange
         self.showMsg('done!')
@@ -307,6 +442,7 @@ class ProjectEnviroment(object):
         self.HetStats = stats
         return (True, None)
             
+    @RunProfile.ProfiledStage('stats')
     def strainStats(self):
         #sortedSeqs,barcodes,primers,minReadNum,lengthRange
         self.showMsg('Generate statistical information of each sample...', end="")
@@ -327,19 +463,24 @@ class ProjectEnviroment(object):
                 for locus in locus_ids:
                     if(locus in strainAlns):
                         seqs = strainAlns[locus]
+                        seqnum = len(seqs)
                         seqpassed = 0
                         if(locus != 'unmapped'):
                             seqpassed = self._SeqPassed(seqs,self.locusLengthRange[locus])
-                            seqcount = str(seqpassed) + '(' + str(len(seqs)) + ')'
+                            if((strain, locus) in self.CappedReads):
+                                capped = self.CappedReads[(strain, locus)]
+                                seqnum += len(capped)
+                                seqpassed += capped.inRange(self.locusLengthRange[locus])
+                            seqcount = str(seqpassed) + '(' + str(seqnum) + ')'
                             outline.append(seqcount)
                         else:
-                            outline.append(str(len(seqs)))
-                        straintotal += len(seqs)
+                            outline.append(str(seqnum))
+                        straintotal += seqnum
                         
                         if(locus in locustotal):
-                            locustotal[locus] += len(seqs)
+                            locustotal[locus] += seqnum
                         else:
-                            locustotal[locus] = len(seqs)
+                            locustotal[locus] = seqnum
                     else:
                         if(locus != 'unmapped'):
                             outline.append('0(0)')
@@ -369,9 +510,15 @@ class ProjectEnviroment(object):
         self.showMsg('done!')
         return (True, None)
     
+    @RunProfile.ProfiledStage('consensus')
     def GenerateConsensus(self):
+        self.References = {}
+        if(self.parameters.ConsensusMode == "reference"):
+            isokay, errMsg = self.__readReferences()
+            if(not isokay):
+                return False, errMsg
         consseqs = ConsensusSeqs.ConsensusSeqs(self)
-        isokay, errMsg = consseqs.makeConsensus()
+        isokay, errMsg = consseqs.makeConsensus(self.PipelinedCons)
         if isokay:
             self.consSeqs = consseqs.ConsSeqs
             try:
@@ -391,6 +538,7 @@ class ProjectEnviroment(object):
         else:
             return False, errMsg
     
+    @RunProfile.ProfiledStage('unmapped dump')
     def DumpUnmappedReads(self):
         self.showMsg('Dumping unaligned reads to file...', end="")
         #if(self.msgHandle is not None):
@@ -430,6 +578,7 @@ class ProjectEnviroment(object):
                     outline = '<' + barcode + '>\n'
                     fh_out.write(outline)
                 seqs = unmapSeqs[barcode]
+                self.Profile.reads(len(seqs))
                 for seq in seqs:
                     fh_out.write(seq.seq.format('fasta'))
             fh_out.close()
@@ -440,6 +589,7 @@ class ProjectEnviroment(object):
         except Exception as e:
             return (False, e)
     
+    @RunProfile.ProfiledStage('het search')
     def HetSearch(self):
         hetsearch = HetSearchParallel.HetSearch(self)
         (isokay, errMsg) = hetsearch.Run()
@@ -462,6 +612,20 @@ class ProjectEnviroment(object):
         else:
             return (False, errMsg)
     
+    def closeWorkers(self):
+        self.Workers.close()
+    
+    def resetProfile(self):
+        isokay, error = RunProfile.CheckStage(self.parameters.ProfileStage)
+        if(not isokay):
+            return (False, error)
+        self.Profile = RunProfile.RunProfile(self.parameters.Out_Folder, self.parameters.ProfileStage)
+        return (True, None)
+    
+    def writeProfile(self):
+        profilefile = self.parameters.Out_Folder + "/" + "RunProfile.json"
+        return self.Profile.write(profilefile)
+    
     def _UniqueIDs(self, refseqs, mode):
     ##mode 1 for barcode, mode 2 for primer
         ids = []
@@ -483,4 +647,27 @@ class ProjectEnviroment(object):
         if(self.msgHandle is not None):
             self.msgHandle.emit(msg, end)
         else:
-            sys.stderr.write(str(msg + end))
\ No newline at end of file
+            sys.stderr.write(str(msg + end))
+
+    def showProgress(self, info):
+        if(self.progressHandle is not None):
+            self.progressHandle.emit(info)
+        else:
+            end = "\n" if info.finished else ""
+            sys.stderr.write("\r" + info.text() + end)
+
+
+def MeanQuality(seq):
+    ##reads released by the coverage cap have no qualities left
+    scores = seq.letter_annotations.get("phred_quality", [])
+    if(len(scores) == 0):
+        return 0
+    return sum(scores)/len(scores)
+
+
+def ReadQualities(seqs):
+    """mean phred quality of each read, indexed like seqs"""
+    quals = array('f')
+    for seq in seqs:
+        quals.append(MeanQuality(seq))
+    return quals
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+
+class ReadFilter(object):
+    """class to drop reads by length and mean quality before the barcode search
+
+    A minimum length of 0 means two barcode windows (2 x EndLength), shorter reads cannot
+    hold a barcode at both ends. A maximum length or minimum quality of 0 is no limit.
+    """
+    def __init__(self, paras):
+        self.minlen = paras.MinReadLength
+        if(self.minlen == 0):
+            self.minlen = 2 * paras.EndLength
+        self.maxlen = paras.MaxReadLength
+        self.minqual = paras.MinMeanQuality
+        ##FASTA reads carry a made-up quality
+        if(paras.Filetype == "FASTA"):
+            self.minqual = 0
+
+    def run(self, seqs, quals):
+        """return (indexes of the kept reads, reason -> number of dropped reads)"""
+        lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+        quals = np.frombuffer(quals, dtype=np.float32) if len(quals) > 0 else np.zeros(0, np.float32)
+        short = lengths < self.minlen
+        dropped = short.copy()
+        toolong = np.zeros(len(seqs), dtype=bool)
+        if(self.maxlen > 0):
+            toolong = (lengths > self.maxlen) & ~dropped
+            dropped |= toolong
+        lowqual = np.zeros(len(seqs), dtype=bool)
+        if(self.minqual > 0):
+            lowqual = (quals < self.minqual) & ~dropped
+            dropped |= lowqual
+        counts = {'short':int(short.sum()), 'long':int(toolong.sum()), 'low_quality':int(lowqual.sum())}
+        return (np.flatnonzero(~dropped), counts)
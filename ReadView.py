@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+COMPLEMENT = str.maketrans("ACGTURYKMBVDHacgturykmbvdh", "TGCAAYRMKVBHDtgcaayrmkvbhd")
+
+
+def ReverseComplement(bases):
+    return bases.translate(COMPLEMENT)[::-1]
+
+
+class ReadView(object):
+    """class to view one strand of read[start:end] without copying the bases"""
+    def __init__(self, read, start=None, end=None, strand='+'):
+        self.read = read
+        self.start, self.end, step = slice(start, end).indices(len(read))
+        if(self.end < self.start):
+            self.end = self.start
+        self.strand = strand
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if(not isinstance(index, slice) or index.step not in (None, 1)):
+            raise TypeError("ReadView only supports contiguous slices")
+        start, end, step = index.indices(len(self))
+        if(end < start):
+            end = start
+        if(self.strand == '+'):
+            return ReadView(self.read, self.start + start, self.start + end, '+')
+        return ReadView(self.read, self.end - end, self.end - start, '-')
+
+    def reverse_complement(self):
+        strand = '-' if self.strand == '+' else '+'
+        return ReadView(self.read, self.start, self.end, strand)
+
+    @property
+    def seq(self):
+        """bases of the view on its own strand"""
+        bases = self.read[self.start:self.end]
+        if(self.strand == '-'):
+            return ReverseComplement(bases)
+        return bases
+
+    def __str__(self):
+        return self.seq
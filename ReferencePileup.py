@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import numpy as np
+import SWAlign
+
+PILEUP_BASES = "ACGT-"
+GAP = 4
+##reads are trimmed at the primers, so they stay close to the reference diagonal; the band
+##covers the locus length range around the reference plus this many diagonals of slack
+BAND_SLACK = 25
+
+_CODES = np.full(256, -1, dtype=np.int8)
+for _code, _base in enumerate("ACGT"):
+    _CODES[ord(_base)] = _code
+    _CODES[ord(_base.lower())] = _code
+
+##bit mask of the winning bases (A=1, C=2, G=4, T=8) -> IUPAC code
+_IUPAC = np.array(['', 'A', 'C', 'M', 'G', 'R', 'S', 'V', 'T', 'W', 'Y', 'H', 'K', 'D', 'B', 'N'])
+_BITS = np.array([1, 2, 4, 8])
+
+
+class ReferencePileup(object):
+    """class to stack reads on a locus reference and call their consensus column by column
+
+    Each unique read costs one banded global alignment in Python, about 0.1s for a 500bp
+    locus, so a bucket costs up to Max_ReadNum of them.
+    """
+    def __init__(self, reference, paras, lenRange=None):
+        self.reference = reference.upper()
+        self.bandwidth = BandWidth(len(self.reference), lenRange)
+        self.sw = SWAlign.LocalAlignment(SWAlign.NucleotideScoringMatrix(paras.MatchScore, paras.MismatchScore),
+                                         paras.GapScore, globalalign=True)
+        self.counts = np.zeros((len(self.reference), len(PILEUP_BASES)))
+        ##reference position -> base counts of each column inserted before it
+        self.insertions = {}
+        self.depth = 0
+
+    def add(self, read, weight=1):
+        """globally align one read to the reference and add it to the pileup weight times"""
+        align = self.sw.align(self.reference, read, band_width=self.bandwidth)
+        codes = _CODES[np.frombuffer(read.encode(), dtype=np.uint8)]
+        refpos = []
+        readcodes = []
+        i = align.r_pos
+        j = align.q_pos
+        for count, op in align.cigar:
+            if op == 'M':
+                refpos.append(np.arange(i, i + count))
+                readcodes.append(codes[j:j + count])
+                i += count
+                j += count
+            elif op == 'D':
+                refpos.append(np.arange(i, i + count))
+                readcodes.append(np.full(count, GAP, dtype=np.int8))
+                i += count
+            elif op == 'I':
+                self._insert(i, codes[j:j + count], weight)
+                j += count
+        if(len(refpos) > 0):
+            refpos = np.concatenate(refpos)
+            readcodes = np.concatenate(readcodes)
+            ##ambiguous read bases do not vote
+            voted = readcodes >= 0
+            np.add.at(self.counts, (refpos[voted], readcodes[voted]), weight)
+        self.depth += weight
+
+    def _insert(self, pos, codes, weight):
+        columns = self.insertions.setdefault(pos, [])
+        for k, code in enumerate(codes):
+            if(k == len(columns)):
+                columns.append(np.zeros(len(PILEUP_BASES)))
+            if(code >= 0):
+                columns[k][code] += weight
+
+    def consensus(self):
+        """majority base of every column, ties between bases as IUPAC codes, gap winners dropped"""
+        calls = _CallColumns(self.counts)
+        consensus = []
+        for pos in range(len(self.reference) + 1):
+            if(pos in self.insertions):
+                columns = np.array(self.insertions[pos])
+                ##reads without the insertion have a gap in its columns
+                columns[:, GAP] = self.depth - columns.sum(axis=1)
+                consensus.extend(_CallColumns(columns))
+            if(pos < len(self.reference)):
+                consensus.append(calls[pos])
+        return ''.join(consensus)
+
+
+def BandWidth(reflen, lenRange=None):
+    """diagonals kept on both sides of the straight path for reads in the locus length range"""
+    if(lenRange is None):
+        return 2 * BAND_SLACK
+    offset = max(abs(lenRange['s1'] - reflen), abs(lenRange['s2'] - reflen))
+    return int(offset) + BAND_SLACK
+
+
+def _CallColumns(counts):
+    top = counts.max(axis=1, keepdims=True)
+    winners = (counts == top) & (top > 0)
+    basemask = winners[:, :GAP].dot(_BITS)
+    ##a gap tied with a base loses, as in the MSA vote
+    return _IUPAC[basemask]
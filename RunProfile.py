@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import json
+import cProfile
+import pstats
+from contextlib import contextmanager
+from threading import Lock
+from time import time, process_time
+
+##stage names a run can report, Profile_Stage has to be one of them
+STAGES = ['load', 'align', 'barcode search', 'primer search', 'pipelined buckets', 'sort', 'lengths',
+          'stats', 'consensus', 'unmapped dump', 'het search']
+##stages whose work runs in pool workers, their tasks return the worker cProfile stats
+WORKER_STAGES = ['align', 'barcode search', 'primer search', 'het search']
+
+
+class StageRecord(object):
+    """class to store timing and counters of one pipeline stage"""
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.reads = 0
+        self.counters = {}
+        self.workerbusy = []
+        self.workercpu = []
+        self.workernum = 0
+        ##name of the enclosing stage, None for a top-level stage
+        self.parent = None
+        ##True when the stage ran beside other stages rather than after them
+        self.concurrent = False
+        self._t0 = 0.0
+        self._c0 = 0.0
+
+    def utilization(self):
+        if(self.workernum == 0 or self.wall <= 0):
+            return None
+        return sum(self.workerbusy) / (self.wall * self.workernum)
+
+    def todict(self):
+        counters = dict(self.counters)
+        if(counters.get('muscle_calls', 0) > 0):
+            counters['muscle_mean_latency'] = round(counters['muscle_seconds'] / counters['muscle_calls'], 4)
+        info = {'name':self.name, 'wall':round(self.wall, 4), 'cpu':round(self.cpu, 4),
+                'reads':self.reads, 'counters':counters}
+        if(self.parent is not None):
+            info['parent'] = self.parent
+        if(self.concurrent):
+            info['concurrent'] = True
+        if(self.wall > 0 and self.reads > 0):
+            info['reads_per_sec'] = round(self.reads / self.wall, 2)
+        if(self.workernum > 0):
+            utilization = self.utilization()
+            info['workers'] = {'count':self.workernum,
+                               'busy':[round(t, 4) for t in self.workerbusy],
+                               'cpu':[round(t, 4) for t in self.workercpu],
+                               'utilization':round(utilization, 4) if utilization is not None else None}
+        return info
+
+
+class RunProfile(object):
+    """class to collect per-stage timing of a project run"""
+    def __init__(self, outfolder="", profilestage=""):
+        self.outfolder = outfolder
+        self.profilestage = profilestage
+        self.stages = []
+        self.current = None
+        self.profilefile = ""
+        ##cProfile stats returned by the worker tasks of the profiled stage
+        self.workerstats = []
+        ##counters may be updated from several threads of a stage
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, name):
+        record = StageRecord(name)
+        previous = self.current
+        if(previous is not None):
+            record.parent = previous.name
+        self.current = record
+        self.stages.append(record)
+        profiler = None
+        if(name == self.profilestage):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        record._t0 = time()
+        record._c0 = process_time()
+        try:
+            yield record
+        finally:
+            record.wall += time() - record._t0
+            record.cpu += process_time() - record._c0
+            if(profiler is not None):
+                profiler.disable()
+                self.dumpStats(name, profiler)
+            self.current = previous
+
+    def addWorkerStats(self, stats):
+        """keep the cProfile stats a worker task returned, None when it did not profile"""
+        if(stats is not None):
+            self.workerstats.append(_ProfileStats(stats))
+
+    def dumpStats(self, name, profiler=None):
+        """write the parent and worker cProfile stats of the profiled stage to profile.<stage>.prof"""
+        sources = list(self.workerstats)
+        if(profiler is not None):
+            sources.insert(0, profiler)
+        self.workerstats = []
+        if(len(sources) == 0):
+            return
+        self.profilefile = self.outfolder + "/profile." + name.replace(' ', '_') + ".prof"
+        pstats.Stats(*sources).dump_stats(self.profilefile)
+
+    def count(self, counter, value=1):
+        if(self.current is None):
+            return
+        with self._lock:
+            counters = self.current.counters
+            if(counter in counters):
+                counters[counter] += value
+            else:
+                counters[counter] = value
+
+    def reads(self, readnum):
+        if(self.current is not None):
+            with self._lock:
+                self.current.reads += readnum
+
+    def muscle(self, calls, seconds):
+        self.count('muscle_calls', calls)
+        self.count('muscle_seconds', seconds)
+
+    def workers(self, workernum, busy, cpu):
+        if(self.current is not None):
+            self.current.workernum = workernum
+            self.current.workerbusy += list(busy)
+            self.current.workercpu += list(cpu)
+
+    def workerStage(self, name, workernum, busy, cpu, readnum=0):
+        """add a child of the current stage from the time its workers spent on name"""
+        record = StageRecord(name)
+        if(self.current is not None):
+            record.parent = self.current.name
+        record.workernum = workernum
+        record.workerbusy = list(busy)
+        record.workercpu = list(cpu)
+        record.wall = max(record.workerbusy) if len(record.workerbusy) > 0 else 0.0
+        record.cpu = sum(record.workercpu)
+        record.reads = readnum
+        self.stages.append(record)
+        if(name == self.profilestage):
+            self.dumpStats(name)
+        return record
+
+    def todict(self):
+        info = {'stages':[record.todict() for record in self.stages],
+                'total_wall':round(self.totalWall(), 4)}
+        if(self.profilestage != ""):
+            info['profiled_stage'] = self.profilestage
+            info['profile_file'] = self.profilefile
+        return info
+
+    def totalWall(self):
+        """wall time of the top-level stages that ran one after another"""
+        return sum(record.wall for record in self.stages if record.parent is None and not record.concurrent)
+
+    def write(self, filename):
+        try:
+            with open(filename, 'w') as fh_out:
+                json.dump(self.todict(), fh_out, indent=2)
+            return (True, None)
+        except IOError as e:
+            return (False, e)
+
+
+class _ProfileStats(object):
+    """class to hand the stats dict of a worker profiler to pstats.Stats"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class WorkerProfiler(object):
+    """class to capture cProfile stats of the profiled stage inside a pool worker task"""
+    def __init__(self, profilestage):
+        self.profilestage = profilestage
+        self.profiler = None
+
+    def start(self, *stages):
+        if(self.profilestage in stages):
+            if(self.profiler is None):
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self, *stages):
+        """stop capturing, only when the profiled stage is in stages if any are given"""
+        if(self.profiler is not None and (len(stages) == 0 or self.profilestage in stages)):
+            self.profiler.disable()
+
+    def stats(self):
+        """stats dict for the parent to merge, None when nothing was captured"""
+        if(self.profiler is None):
+            return None
+        self.profiler.disable()
+        self.profiler.create_stats()
+        return self.profiler.stats
+
+
+def CheckStage(name):
+    """(isokay, err) of a Profile_Stage setting, empty means no cProfile capture"""
+    if(name == "" or name in STAGES):
+        return (True, None)
+    return (False, "Unknown Profile_Stage '%s', use one of: %s" %(name, ', '.join(STAGES)))
+
+
+def ProfiledStage(name):
+    """run a ProjectEnviroment method inside a stage of its RunProfile"""
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            with self.Profile.stage(name):
+                return func(self, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
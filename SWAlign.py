@@ -3,6 +3,7 @@
 Simple Smith-Waterman aligner
 '''
 import sys
+from collections import OrderedDict
 from io import StringIO
 
 
@@ -27,7 +28,7 @@ class ScoringMatrix(object):
         if filename:
             fs = open(filename)
         else:
-            fs = StringIO.StringIO(text)
+            fs = StringIO(text)
 
         self.scores = []
         self.bases = None
@@ -45,27 +46,72 @@ class ScoringMatrix(object):
 
         fs.close()
 
+        # bases missing from the matrix score as the first base
+        self.codes = dict((b, i) for i, b in enumerate(self.bases))
+        self.table = [self.scores[i * self.base_count:(i + 1) * self.base_count]
+                      for i in range(self.base_count)]
+        self.max_score = max(self.scores)
+
+    def encode(self, seq):
+        return [self.codes.get(b, 0) for b in seq]
+
     def score(self, one, two):
-        one_idx = 0
-        two_idx = 0
-        for i, b in enumerate(self.bases):
-            if b == one:
-                one_idx = i
-            if b == two:
-                two_idx = i
+        return self.table[self.codes.get(one, 0)][self.codes.get(two, 0)]
+
+
+IUPAC_BASES = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+__tables = {}
+
+
+def _nucleotide_table(match, mismatch, iupac):
+    '''
+    128x128 table over ASCII codes; IUPAC codes, identical ambiguity codes
+    included, score the rounded expected match/mismatch score of their base
+    sets, so only plain bases score a full match
+    '''
+    key = (match, mismatch, iupac)
+    if key in __tables:
+        return __tables[key]
+
+    table = []
+    for one in range(128):
+        row = []
+        for two in range(128):
+            a = chr(one).upper()
+            b = chr(two).upper()
+            if iupac and a in IUPAC_BASES and b in IUPAC_BASES:
+                bases_a = IUPAC_BASES[a]
+                bases_b = IUPAC_BASES[b]
+                shared = len(set(bases_a) & set(bases_b))
+                p = float(shared) / (len(bases_a) * len(bases_b))
+                row.append(int(round(p * match + (1 - p) * mismatch)))
+            elif one and two and a == b:
+                row.append(match)
+            else:
+                row.append(mismatch)
+        table.append(row)
 
-        return self.scores[(one_idx * self.base_count) + two_idx]
+    __tables[key] = (table, max(max(row) for row in table))
+    return __tables[key]
 
 
 class NucleotideScoringMatrix(object):
-    def __init__(self, match=1, mismatch=-1):
+    def __init__(self, match=1, mismatch=-1, iupac=True):
         self.match = match
         self.mismatch = mismatch
+        self.iupac = iupac
+        self.table, self.max_score = _nucleotide_table(match, mismatch, iupac)
+
+    def encode(self, seq):
+        # non-ASCII symbols map to 0, which never matches
+        return [ord(b) if ord(b) < 128 else 0 for b in seq]
 
     def score(self, one, two):
-        if one == two:
-            return self.match
-        return self.mismatch
+        return self.table[self.encode(one)[0]][self.encode(two)[0]]
 
 
 class Matrix(object):
@@ -91,14 +137,62 @@ class LocalAlignment(object):
         self.prefer_gap_runs = prefer_gap_runs
         self.globalalign = globalalign
 
-    def align(self, ref, query, ref_name='', query_name='', rc=False):
+    def band(self, ref_len, query_len, min_score):
+        '''
+        Diagonal range (row - col) that every local path scoring at least
+        min_score stays in, or None when the scoring does not allow banding.
+
+        A path scoring S has at least ceil(S / max_score) diagonal steps when
+        gaps never score positive, so its cells satisfy
+        steps - ref_len <= row - col <= query_len - steps.  With linear gaps
+        every cell value is a plain Smith-Waterman maximum, so cells on such
+        paths get the same values and traceback ops inside the band.
+        '''
+        if min_score is None or min_score <= 0 or self.globalalign or self.gap_extension_decay:
+            return None
+        if self.gap_penalty != self.gap_extension_penalty or self.gap_penalty > 0:
+            return None
+        max_score = getattr(self.scoring_matrix, 'max_score', None)
+        if max_score is None or max_score <= 0:
+            return None
+        min_steps = -(-min_score // max_score)
+        return (min_steps - ref_len, query_len - min_steps)
+
+    def global_band(self, ref_len, query_len, band_width):
+        '''
+        Diagonal range (row - col) within band_width of the straight path
+        from (0, 0) to (query_len, ref_len), or None outside global mode.
+
+        Unlike band() this is a heuristic for colinear sequences: global
+        paths wandering further off the diagonal are not considered.
+        '''
+        if band_width is None or not self.globalalign:
+            return None
+        shift = query_len - ref_len
+        return (min(0, shift) - band_width, max(0, shift) + band_width)
+
+    def align(self, ref, query, ref_name='', query_name='', rc=False, min_score=None, band_width=None):
+        '''
+        With min_score the DP is restricted to band(); alignments scoring at
+        least min_score are identical to the full DP, weaker ones may differ
+        but still score below min_score.  In global mode band_width restricts
+        the DP to global_band() instead.
+        '''
         orig_ref = ref
         orig_query = query
 
         ref = ref.upper()
         query = query.upper()
 
-        matrix = Matrix(len(query) + 1, len(ref) + 1, (0, ' ', 0))
+        diagonals = self.band(len(ref), len(query), min_score)
+        init = (0, ' ', 0)
+        if diagonals is None and band_width is not None and self.globalalign:
+            diagonals = self.global_band(len(ref), len(query), band_width)
+            # off-band cells must lose against negative global scores
+            init = (float('-inf'), ' ', 0)
+
+        matrix = Matrix(len(query) + 1, len(ref) + 1, init)
+        matrix.set(0, 0, (0, ' ', 0))
         for row in range(1, matrix.rows):
             matrix.set(row, 0, (0, 'i', 0))
 
@@ -109,10 +203,25 @@ class LocalAlignment(object):
         max_row = 0
         max_col = 0
 
+        # dense score table lookups where the scoring matrix provides one
+        table = getattr(self.scoring_matrix, 'table', None)
+        if table is not None:
+            ref_codes = self.scoring_matrix.encode(ref)
+            query_codes = self.scoring_matrix.encode(query)
+
         # calculate matrix
         for row in range(1, matrix.rows):
-            for col in range(1, matrix.cols):
-                mm_val = matrix.get(row - 1, col - 1)[0] + self.scoring_matrix.score(query[row - 1], ref[col - 1])
+            if diagonals is None:
+                cols = range(1, matrix.cols)
+            else:
+                cols = range(max(1, row - diagonals[1]), min(matrix.cols, row - diagonals[0] + 1))
+            if table is not None:
+                table_row = table[query_codes[row - 1]]
+                row_scores = [table_row[code] for code in ref_codes]
+            else:
+                row_scores = [self.scoring_matrix.score(query[row - 1], b) for b in ref]
+            for col in cols:
+                mm_val = matrix.get(row - 1, col - 1)[0] + row_scores[col - 1]
 
                 ins_run = 0
                 del_run = 0
@@ -556,22 +665,71 @@ def extract_region(comments):
     return None
 
 
-__revcomp = {}
-for a, b in zip('atcgATCGNn', 'tagcTAGCNn'):
-    __revcomp[a] = b
-__cache = {}
+__IUPAC = 'ACGTURYSWKMBDHVN'
+__IUPAC_COMP = 'TGCAAYRSWMKVHDBN'
+__revcomp = str.maketrans(__IUPAC + __IUPAC.lower(), __IUPAC_COMP + __IUPAC_COMP)
+__revcomp_bytes = bytes.maketrans((__IUPAC + __IUPAC.lower()).encode(), (__IUPAC_COMP + __IUPAC_COMP).encode())
+__valid = str.maketrans('', '', __IUPAC + __IUPAC.lower())
+
+
+class RevcompCache(object):
+    '''
+    Bounded LRU memo of reverse complements with hit/miss/eviction counters
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, seq):
+        if seq in self.records:
+            self.hits += 1
+            self.records.move_to_end(seq)
+            return self.records[seq]
+        self.misses += 1
+        return None
+
+    def put(self, seq, rc):
+        if self.maxsize <= 0:
+            return
+        self.records[seq] = rc
+        if len(self.records) > self.maxsize:
+            self.records.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'size': len(self.records), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+__cache = RevcompCache()
 
 
 def revcomp(seq):
-    if seq in __cache:
-        return __cache[seq]
+    '''
+    Upper-case reverse complement of a str or bytes sequence of IUPAC codes
+    '''
+    ret = __cache.get(seq)
+    if ret is not None:
+        return ret
+
+    if isinstance(seq, bytes):
+        if seq.decode('ascii', 'replace').translate(__valid):
+            raise ValueError('Invalid base in sequence: %s' % seq)
+        ret = seq.translate(__revcomp_bytes)[::-1]
+    else:
+        if seq.translate(__valid):
+            raise ValueError('Invalid base in sequence: %s' % seq)
+        ret = seq.translate(__revcomp)[::-1]
+
+    __cache.put(seq, ret)
+    return ret
 
-    ret = []
-    for s in seq.upper()[::-1]:
-        ret.append(__revcomp[s])
 
-    __cache[seq] = ''.join(ret)
-    return __cache[seq]
+def revcomp_stats():
+    return __cache.stats()
 
 
 #     sw.align('ACACACTA','AGCACACA').dump()
@@ -1,6 +1,15 @@
-from multiprocessing import Process, Queue, Manager
-from time import time, sleep
+from collections import OrderedDict
+from os import getpid
+from time import time, process_time
 from sys import stderr
+import LengthHistogram
+import Progress
+import AlignCheckpoint
+import CoverageCap
+import AhoCorasick
+import ReadView
+import WorkerPool
+import RunProfile
 
 class AlignRecord(object):
     """class to store single align result"""
@@ -17,9 +26,10 @@ class AlignRecord(object):
 
 class AlignedSeq(object):
     """class to store multiple align results for one seq"""
-    def __init__(self,seq):
+    def __init__(self,seq,seqidx=-1):
         self.seq = seq
         self.seqid = seq.id
+        self.seqidx = seqidx
         self.barcode = ""
         self.strain = ""
         self.gene = ""
@@ -48,6 +58,16 @@ class AlignedSeq(object):
                 trimseq = trimseq.reverse_complement(id=True,name=True,description=True)
             return trimseq
     
+    def BarcodeView(self):
+        """ReadView of TrimBarcode() without copying the read"""
+        strand = "-" if self.alnBarcode.dir == "-" else "+"
+        return ReadView.ReadView(str(self.seq.seq), self.alnBarcode.le + 1, self.alnBarcode.rs, strand)
+    
+    def PrimerView(self):
+        """ReadView of TrimPrimer() without copying the read"""
+        strand = "-" if self.alnPrimer.dir == "-" else "+"
+        return ReadView.ReadView(str(self.seq.seq), self.alnPrimer.le + 1, self.alnPrimer.rs + 1, strand)
+    
     def BarcodeFreeRegion(self):
         seq_s = self.alnBarcode.le + 1
         seq_e = self.alnBarcode.rs
@@ -58,6 +78,12 @@ class AlignedSeq(object):
         seq_e = self.alnPrimer.rs + 1
         length = seq_e - seq_s
         return (length)
+    
+    def TrimmedLength(self):
+        """length of TrimPrimer() without slicing the read"""
+        seq_s = self.alnPrimer.le + 1
+        seq_e = self.alnPrimer.rs + 1
+        return len(range(len(self.seq))[seq_s:seq_e])
 
 
 class AlignRes(object):
@@ -98,8 +124,6 @@ class SeqAlignments(object):
     """class to store all aligned sequences"""
     def __init__(self, projenv):
         self.alignedseqs = []
-        self.seqgroups = []
-        self.workers = []
         self.paras = projenv.parameters
         self.seqs = projenv.Seqs
         self.barcodes = projenv.Barcodes
@@ -107,6 +131,16 @@ class SeqAlignments(object):
         self.msgHandle = projenv
         self.threadNum = self.paras.Threads
         self.symbarcode = projenv.SymBarcode
+        self.designfile = projenv.Design.path if projenv.Design is not None else ""
+        self.profile = projenv.Profile
+        self.workers = projenv.Workers
+        self.pipeline = projenv.Pipeline
+        self.quals = projenv.SeqQuals
+        self.cap = None
+        self.cappedreads = {}
+        self.lengthhists = {}
+        self.num_unbarcode = 0
+        self.num_unprimer = 0
 
     # def Run(self):
     #     stats = list()
@@ -128,85 +162,296 @@ class SeqAlignments(object):
     #     self.msgHandle.showMsg('Done!')
 
     def Run(self):
-        self.msgHandle.showMsg("Searching for barcodes in reads...")
-        groupnum = int(len(self.seqs)/self.threadNum)
-        for i in range(self.threadNum):
-            startnum = groupnum * i
-            endnum = groupnum * (i+1)
-            if(i == self.threadNum - 1):
-                endnum = len(self.seqs)
-            self.seqgroups.append(self.seqs[startnum:endnum])
-
-        manager = Manager()
-        alignedseqs = manager.list()
-        primeredseqs = manager.list()
-        stats = manager.list()
-        unbarcode = manager.list()
-        unprimer = manager.list()
-
-        for i in range(self.threadNum):
-            self.msgHandle.showMsg("Open thread +1")
-            child = Process(target=BarcodeSearch,
-                            args=(self.paras, self.seqgroups[i],
-                                  self.barcodes, self.symbarcode, stats, alignedseqs, unbarcode))
-            self.msgHandle.showMsg("Searching for barcodes in reads...")
-            child.start()
-            self.workers.append(child)
-
-        totalcount = 0
-        while any(i.is_alive() for i in self.workers):
-            sleep(0.1)
-            while len(stats) > 0:
-                totalcount += 100
-                if(totalcount % 1000 == 0):
-                    self.msgHandle.showMsg("%s reads have been processed..."
-                                           %(totalcount))
-                stats.pop()
+        self.msgHandle.showMsg("Searching for barcodes and primers in reads...")
+        chunksize = max(int(self.paras.AlignChunkSize), 1)
+        if(self.paras.DedupReads):
+            readidxs, copies = UniqueReads(self.seqs)
+            self.msgHandle.showMsg("%s unique sequences in %s reads" %(len(readidxs), len(self.seqs)))
+        else:
+            readidxs, copies = range(len(self.seqs)), None
+        chunknum = int((len(readidxs) + chunksize - 1) / chunksize)
+        signature = AlignCheckpoint.AlignSignature(self.paras, self.seqs, self.barcodes, self.primers,
+                                                   self.symbarcode)
+        checkpoint = AlignCheckpoint.AlignCheckpoint(AlignCheckpoint.CheckpointFolder(self.paras.Out_Folder),
+                                                   signature)
+        isokay, error = checkpoint.open()
+        if(not isokay):
+            return (False, error)
+
+        if(self.paras.CoverageCap > 0):
+            self.cap = CoverageCap.CoverageCap(self.paras.CoverageCap * self.paras.MaxReadNum, self.quals)
+        results = {}
+        for chunkidx in checkpoint.committed():
+            if(chunkidx < chunknum):
+                results[chunkidx] = checkpoint.load(chunkidx)
+        if(len(results) > 0):
+            self.msgHandle.showMsg("%s of %s read chunks restored from checkpoints" %(len(results), chunknum))
+            if(self.pipeline is not None):
+                for chunkidx in sorted(results):
+                    self.pipeline.addChunk(chunkidx, self._ChunkSeqs(results[chunkidx], copies))
+            if(self.cap is not None):
+                for chunkidx in sorted(results):
+                    self._CapChunk(results[chunkidx], copies)
+        pending = [chunkidx for chunkidx in range(chunknum) if chunkidx not in results]
+        pendingreads = sum(len(readidxs[chunkidx*chunksize:(chunkidx+1)*chunksize]) for chunkidx in pending)
+
+        with self.profile.stage('align'):
+            self.msgHandle.showMsg("Use %s threads" %(self.threadNum))
+            pool = self.workers.pool(self.threadNum)
+            self.workers.stopevent.clear()
+            listener = Progress.ProgressListener('alignment', pendingreads, self.workers.progress,
+                                                 self.msgHandle.showProgress)
+            listener.start()
+            ##workers build the matchers and caches once per context, not once per chunk
+            context = (signature + ":%s:%s" %(self.paras.WindowCacheSize, self.paras.BandedAlign),
+                       self.paras, self.barcodes, self.primers, self.symbarcode, self.designfile)
+            tasks = ((context, listener.runid) + _ChunkTask(self.seqs, readidxs, chunkidx, chunksize)
+                     for chunkidx in pending)
+            workerbusy = {}
+            workercpu = {}
+            ##per worker [barcode busy, barcode cpu, primer busy, primer cpu]
+            searchtimes = {}
+            barcodedreads = 0
+            try:
+                for result in pool.imap_unordered(AlignChunk, tasks):
+                    if(result is None):
+                        continue
+                    ##worker cProfile stats are not part of the checkpoint
+                    self.profile.addWorkerStats(result.pop('profile'))
+                    checkpoint.commit(result['chunk'], result)
+                    results[result['chunk']] = result
+                    if(self.pipeline is not None):
+                        self.pipeline.addChunk(result['chunk'], self._ChunkSeqs(result, copies))
+                    if(self.cap is not None):
+                        self._CapChunk(result, copies)
+                    worker = result['worker']
+                    workerbusy[worker] = workerbusy.get(worker, 0) + result['busy']
+                    workercpu[worker] = workercpu.get(worker, 0) + result['cpu']
+                    times = searchtimes.setdefault(worker, [0.0, 0.0, 0.0, 0.0])
+                    for k, key in enumerate(['barcode_time', 'barcode_cpu', 'primer_time', 'primer_cpu']):
+                        times[k] += result[key]
+                    barcodedreads += len(result['aligns']) + result['unprimer']
+                    self.profile.count('barcode_seconds', result['barcode_time'])
+                    self.profile.count('primer_seconds', result['primer_time'])
+                    self.profile.count('chunks_aligned')
+                    for counter in result['cache']:
+                        self.profile.count(counter, result['cache'][counter])
+            finally:
+                listener.stop()
+            self.profile.reads(pendingreads)
+            self.profile.count('chunks_restored', chunknum - len(pending))
+            if(copies is not None):
+                self.profile.count('duplicate_reads', len(self.seqs) - len(readidxs))
+            if(self.cap is not None):
+                self.profile.count('capped_reads', self.cap.numdropped)
+            self.profile.workers(self.threadNum, list(workerbusy.values()), list(workercpu.values()))
+            ##both searches run inside each chunk task, their worker time is reported as child stages
+            times = list(searchtimes.values())
+            self.profile.workerStage('barcode search', self.threadNum, [t[0] for t in times], [t[1] for t in times],
+                                     pendingreads)
+            self.profile.workerStage('primer search', self.threadNum, [t[2] for t in times], [t[3] for t in times],
+                                     barcodedreads)
+
+        if(len(results) < chunknum):
+            return (False, "Alignment was stopped, %s of %s read chunks have been saved and will be "
+                           "reused in the next run" %(len(results), chunknum))
+
+        if(self.cap is not None):
+            self._CollectCapped()
+        elif(copies is None):
+            self._CollectChunks(results, chunknum)
+        else:
+            self._ExpandChunks(results, chunknum, copies)
         self.msgHandle.showMsg('Done!')
+        return (True, None)
 
-        for self.worker in self.workers:
-            self.worker.join()
+    def _CollectChunks(self, results, chunknum):
+        self.alignedseqs = []
+        self.num_unbarcode = 0
+        self.num_unprimer = 0
+        for chunkidx in range(chunknum):
+            result = results[chunkidx]
+            for seqidx, barcode, strain, alnBarcode, gene, alnPrimer in result['aligns']:
+                self.alignedseqs.append(self._AlignedSeq(seqidx, barcode, strain, alnBarcode, gene,
+                                                         alnPrimer))
+            self.num_unbarcode += result['unbarcode']
+            self.num_unprimer += result['unprimer']
+            LengthHistogram.MergeHistograms(self.lengthhists, result['hists'])
 
-        self.workers = []
-        self.msgHandle.showMsg("Searching for primers in reads...")
+    def _ExpandChunks(self, results, chunknum, copies):
+        """give every copy of a unique read the alignment of its representative"""
+        self.alignedseqs = []
+        self.num_unprimer = 0
+        for chunkidx in range(chunknum):
+            for seqidx, barcode, strain, alnBarcode, gene, alnPrimer in results[chunkidx]['aligns']:
+                copyidxs = copies.get(seqidx, [seqidx])
+                for copyidx in copyidxs:
+                    self.alignedseqs.append(self._AlignedSeq(copyidx, barcode, strain, alnBarcode, gene,
+                                                             alnPrimer))
+                if(alnPrimer == ""):
+                    self.num_unprimer += len(copyidxs)
+                else:
+                    if(gene not in self.lengthhists):
+                        self.lengthhists[gene] = LengthHistogram.LengthHistogram()
+                    self.lengthhists[gene].add(self.alignedseqs[-1].LocusLength(), len(copyidxs))
+        self.alignedseqs.sort(key=lambda alignSeq: alignSeq.seqidx)
+        self.num_unbarcode = len(self.seqs) - len(self.alignedseqs)
 
-        for i in range(self.threadNum):
-            child = Process(target=PrimerSearch,
-                            args=(self.paras, alignedseqs[i],
-                                  self.primers, stats, unprimer,primeredseqs))
-            child.start()
-            self.workers.append(child)
+    def _CapChunk(self, result, copies):
+        """pass the aligns of one chunk through the coverage cap and release them"""
+        ##the locus lengths go in first, the cap ranks by the running length range
+        for seqidx, barcode, strain, alnBarcode, gene, alnPrimer in result['aligns']:
+            if(copies is None):
+                break
+            copynum = len(copies.get(seqidx, [seqidx]))
+            if(alnPrimer == ""):
+                self.num_unprimer += copynum
+            else:
+                if(gene not in self.lengthhists):
+                    self.lengthhists[gene] = LengthHistogram.LengthHistogram()
+                self.lengthhists[gene].add(alnPrimer.rs - alnPrimer.le, copynum)
+        if(copies is None):
+            self.num_unprimer += result['unprimer']
+            LengthHistogram.MergeHistograms(self.lengthhists, result['hists'])
+        self.cap.setRanges(self.lengthhists)
+        for seqidx, barcode, strain, alnBarcode, gene, alnPrimer in result['aligns']:
+            copyidxs = [seqidx] if copies is None else copies.get(seqidx, [seqidx])
+            for copyidx in copyidxs:
+                self.cap.add((copyidx, barcode, strain, alnBarcode, gene, alnPrimer))
+        result['aligns'] = []
 
-        totalcount = 0
+    def _CollectCapped(self):
+        self.alignedseqs = []
+        for seqidx, barcode, strain, alnBarcode, gene, alnPrimer in self.cap.aligns():
+            self.alignedseqs.append(self._AlignedSeq(seqidx, barcode, strain, alnBarcode, gene, alnPrimer))
+        self.num_unbarcode = len(self.seqs) - len(self.alignedseqs) - self.cap.numdropped
+        self.cappedreads = self.cap.dropped
+        ##capped reads are only counted, their records keep the read id but not the sequence
+        for seqidx in self.cap.droppedidxs:
+            CoverageCap.ReleaseRead(self.seqs[seqidx])
+        self.cap = None
 
-        while any(i.is_alive() for i in self.workers):
-            sleep(0.1)
-            while len(stats) > 0:
-                totalcount += 100
-                if(totalcount % 1000 == 0):
-                    self.msgHandle.showMsg("%s reads have been processed..."
-                                           %(totalcount))
-                stats.pop()
+    def _ChunkSeqs(self, result, copies):
+        """aligned reads of one chunk, copies of unique reads included"""
+        alignedseqs = []
+        for seqidx, barcode, strain, alnBarcode, gene, alnPrimer in result['aligns']:
+            copyidxs = [seqidx] if copies is None else copies.get(seqidx, [seqidx])
+            for copyidx in copyidxs:
+                alignedseqs.append(self._AlignedSeq(copyidx, barcode, strain, alnBarcode, gene, alnPrimer))
+        return alignedseqs
 
-        for self.worker in self.workers:
-            self.worker.join()
+    def _AlignedSeq(self, seqidx, barcode, strain, alnBarcode, gene, alnPrimer):
+        alignSeq = AlignedSeq(self.seqs[seqidx], seqidx)
+        alignSeq.barcode = barcode
+        alignSeq.strain = strain
+        alignSeq.alnBarcode = alnBarcode
+        alignSeq.gene = gene
+        alignSeq.alnPrimer = alnPrimer
+        return alignSeq
 
-        self.alignedseqs = [aligned for aligns in primeredseqs for aligned in aligns]
-        self.num_unbarcode = sum(unbarcode)
-        self.num_unprimer = sum(unprimer)
-        self.msgHandle.showMsg('Done!')
-    
     def Stop(self):
-        for worker in self.workers:
-            if(worker.is_alive()):
-                worker.terminate()
-            worker.join()
+        if(self.workers.stopevent is not None):
+            self.workers.stopevent.set()
         return 
-    
+
+
+def UniqueReads(seqs):
+    """return (indexes of the first copy of each sequence, first index -> indexes of all copies)"""
+    firstidx = {}
+    readidxs = []
+    copies = {}
+    for seqidx, seq in enumerate(seqs):
+        seqstr = str(seq.seq)
+        if(seqstr in firstidx):
+            copies[firstidx[seqstr]].append(seqidx)
+        else:
+            firstidx[seqstr] = seqidx
+            readidxs.append(seqidx)
+            copies[seqidx] = [seqidx]
+    return (readidxs, copies)
+
+def _ChunkTask(seqs, readidxs, chunkidx, chunksize):
+    seqidxs = readidxs[chunkidx*chunksize:(chunkidx+1)*chunksize]
+    if(isinstance(seqidxs, range)):
+        return (chunkidx, seqidxs, seqs[seqidxs.start:seqidxs.stop])
+    return (chunkidx, seqidxs, [seqs[seqidx] for seqidx in seqidxs])
+
+
+def _AlignContext(paras, barcodes, primers, symbarcode, designfile=""):
+    context = {'paras':paras, 'barcodes':barcodes, 'primers':primers, 'symbarcode':symbarcode,
+               'barcodecache':None, 'primercache':None}
+    if(paras.WindowCacheSize > 0):
+        context['barcodecache'] = WindowCache(paras.WindowCacheSize)
+        context['primercache'] = WindowCache(paras.WindowCacheSize)
+    if(designfile != ""):
+        ##the compiled design carries the search indexes, built once for the plate layout
+        import pickle
+        with open(designfile, 'rb') as fh_in:
+            design = pickle.load(fh_in)
+        context['barcodematcher'] = design.barcodematcher
+        context['primermatcher'] = design.primermatcher
+        context['pairdecoder'] = design.pairdecoder
+        return context
+    context['barcodematcher'] = AhoCorasick.RefSeqMatcher(barcodes)
+    context['primermatcher'] = AhoCorasick.RefSeqMatcher(primers)
+    context['pairdecoder'] = None
+    if(not symbarcode):
+        context['pairdecoder'] = PairDecoder(barcodes, paras)
+    return context
+
+def AlignChunk(task):
+    """barcode and primer search of one read chunk, None if the run was stopped"""
+    (contextid, paras, barcodes, primers, symbarcode, designfile), runid, chunkidx, seqidxs, seqs = task
+    stopevent = WorkerPool.WorkerState('stopevent')
+    if(stopevent.is_set()):
+        return None
+    t0 = time()
+    c0 = process_time()
+    context = WorkerPool.StageContext('align', contextid, _AlignContext, paras, barcodes, primers,
+                                      symbarcode, designfile)
+    report = Progress.WorkerProgress(WorkerPool.WorkerState('progress'), getpid(), runid)
+    cachestats = _CacheStats(context)
+    profiler = RunProfile.WorkerProfiler(paras.ProfileStage)
+    profiler.start('align', 'barcode search')
+    try:
+        barcoded = BarcodeSearch(paras, seqs, seqidxs, barcodes, symbarcode, report, stopevent,
+                                 context['barcodecache'], context['barcodematcher'], context['pairdecoder'])
+        if(barcoded is None):
+            return None
+        t1 = time()
+        c1 = process_time()
+        profiler.stop('barcode search')
+        profiler.start('primer search')
+        primered = PrimerSearch(paras, barcoded[0], primers, report, stopevent, context['primercache'],
+                                context['primermatcher'])
+        if(primered is None):
+            return None
+    finally:
+        profiler.stop()
+    report(0, flush=True)
+    cachestats = [now - before for now, before in zip(_CacheStats(context), cachestats)]
+    aligns = [(alignSeq.seqidx, alignSeq.barcode, alignSeq.strain, alignSeq.alnBarcode, alignSeq.gene,
+               alignSeq.alnPrimer) for alignSeq in primered[0]]
+    return {'chunk':chunkidx, 'aligns':aligns, 'unbarcode':barcoded[1], 'unprimer':primered[1],
+            'hists':primered[2], 'worker':getpid(), 'barcode_time':t1 - t0, 'primer_time':time() - t1,
+            'barcode_cpu':c1 - c0, 'primer_cpu':process_time() - c1,
+            'busy':time() - t0, 'cpu':process_time() - c0, 'profile':profiler.stats(),
+            'cache':dict(zip(['barcode_cache_hits', 'barcode_cache_misses', 'primer_cache_hits',
+                              'primer_cache_misses'], cachestats))}
+
+def _CacheStats(context):
+    stats = []
+    for cache in (context['barcodecache'], context['primercache']):
+        if(cache is None):
+            stats += [0, 0]
+        else:
+            stats += [cache.hits, cache.misses]
+    return stats
+
 #def BarcodeSearch(self):
-def BarcodeSearch(paras, seqs, barcodes, symbarcode, stats, result, unbarcode):
-    
-    seqcount = 0
+def BarcodeSearch(paras, seqs, seqidxs, barcodes, symbarcode, report, stopevent, cache=None,
+                  matcher=None, decoder=None):
+    """return (barcoded reads, unbarcoded count); unbarcoded reads are reported as done"""
     unmapcount = 0
     alignedseqs = []
     
@@ -214,52 +459,41 @@ def BarcodeSearch(paras, seqs, barcodes, symbarcode, stats, result, unbarcode):
     if(padlen < 0):
         padlen = 0
     reglen = 2*paras.FlankingLength + paras.BarcodeLen
+    if(not symbarcode and decoder is None):
+        decoder = PairDecoder(barcodes, paras)
     
-    for seq in seqs:
+    for seqcount, (seqidx, seq) in enumerate(zip(seqidxs, seqs)):
         # print(seq)
-        seqcount += 1
-        if(seqcount % 100 == 0):
-            stats.append(1)
+        if(seqcount % 100 == 0 and stopevent.is_set()):
+            return None
         
-        isMatch,alnrec = _SeqSearch(paras, seq, barcodes, padlen, reglen)
+        read = ReadView.ReadView(str(seq.seq))
+        if(symbarcode):
+            isMatch,alnrec = _SeqSearch(paras, read, barcodes, padlen, reglen, cache, matcher)
+        else:
+            ##both read orientations are decoded from the same two windows
+            isMatch,alnrec = _SeqSearch(paras, read, barcodes, padlen, reglen, cache, decoder=decoder)
 
+        alignSeq = AlignedSeq(seq, seqidx)
         if(isMatch):
-            alignSeq = AlignedSeq(seq)
             alignSeq.barcode = alnrec.id
             alignSeq.strain = alnrec.des
             alignSeq.alnBarcode = alnrec
-            alignedseqs.append(alignSeq)
         else:
-            if(symbarcode):
-                alignSeq = AlignedSeq(seq)
-                alignSeq.barcode = ''
-                alignSeq.strain = ''
-                alignSeq.alnBarcode = ''
-                alignedseqs.append(alignSeq)
-                unmapcount += 1
-            else:
-                seq_rev = seq.reverse_complement()
-                isMatch,alnrec = _SeqSearch(paras, seq_rev, barcodes, padlen, reglen)
-                if(isMatch):
-                    alignSeq.barcode = alnrec.id
-                    alignSeq.strain = alnrec.des
-                    alignSeq.alnBarcode = alnrec
-                    alignedseqs.append(alignSeq)
-                else:
-                    alignSeq = AlignedSeq(seq)
-                    alignSeq.barcode = ''
-                    alignSeq.strain = ''
-                    alignSeq.alnBarcode = ''
-                    alignedseqs.append(alignSeq)
-                    unmapcount += 1
-
-    result.append(alignedseqs)
-    unbarcode.append(unmapcount)
+            alignSeq.barcode = ''
+            alignSeq.strain = ''
+            alignSeq.alnBarcode = ''
+            unmapcount += 1
+        alignedseqs.append(alignSeq)
+        if(alignSeq.barcode == ''):
+            report()
+
+    return (alignedseqs, unmapcount)
     
     
-def PrimerSearch(paras, alignedseqs, primers, stats, unprimer, primeredseqs):
+def PrimerSearch(paras, alignedseqs, primers, report, stopevent, cache=None, matcher=None):
+    """return (barcoded reads with primer alignments, unprimed count, locus length histograms)"""
     #stderr.write ('\nSearching for self.primers in reads...\n')
-    seqcount = 0
     unmappcount = 0
     maxprimerlen = _MaxPrimerLen(primers)
     padlen = paras.UniLength - paras.FlankingLength
@@ -267,20 +501,19 @@ def PrimerSearch(paras, alignedseqs, primers, stats, unprimer, primeredseqs):
         padlen = 0
     reglen = 2*paras.FlankingLength + maxprimerlen
     primered = []
+    hists = {}
     
-    for barcodedseq in alignedseqs:
-        seqcount += 1
-        if(seqcount % 100 == 0):
-            stats.append(1)
-            #stderr.write (unicode(seqcount) + " reads have been processed...\n")
-            
+    for seqcount, barcodedseq in enumerate(alignedseqs):
         if(barcodedseq.barcode == ''): continue
-        
+        if(seqcount % 100 == 0 and stopevent.is_set()):
+            return None
+        report()
+            
         seqs,seqe = barcodedseq.BarcodeFreeRegion()
         seqr = len(barcodedseq.seq) - seqe
-        trimed_seq = barcodedseq.TrimBarcode()
+        trimed_seq = barcodedseq.BarcodeView()
 
-        isMatch,alnrec = _SeqSearch(paras,trimed_seq,primers,padlen,reglen)
+        isMatch,alnrec = _SeqSearch(paras,trimed_seq,primers,padlen,reglen,cache,matcher)
         if(isMatch):
             alnrec = _AlignAddPad(alnrec,seqs)
             barcodedseq.alnPrimer = alnrec
@@ -288,7 +521,7 @@ def PrimerSearch(paras, alignedseqs, primers, stats, unprimer, primeredseqs):
         else:
             trimed_seq_rv = trimed_seq.reverse_complement()
             #print (trimed_seq_rv.format("fasta"))
-            isMatch,alnrec = _SeqSearch(paras,trimed_seq_rv,primers,padlen,reglen)
+            isMatch,alnrec = _SeqSearch(paras,trimed_seq_rv,primers,padlen,reglen,cache,matcher)
             if(isMatch):
                 alnrec = _AlignAddPad(alnrec,seqr)
                 seq_len = len(barcodedseq.seq) - 1
@@ -304,25 +537,159 @@ def PrimerSearch(paras, alignedseqs, primers, stats, unprimer, primeredseqs):
                 alnrec.dir = "-"
                 barcodedseq.gene = alnrec.id
                 barcodedseq.alnPrimer = alnrec
+        if(isMatch):
+            if(barcodedseq.gene not in hists):
+                hists[barcodedseq.gene] = LengthHistogram.LengthHistogram()
+            hists[barcodedseq.gene].add(barcodedseq.LocusLength())
         primered.append(barcodedseq)
         if(not isMatch): unmappcount += 1
-    primeredseqs.append(primered)
-    unprimer.append(unmappcount)
+    return (primered, unmappcount, hists)
     
-def _SeqSearch(paras,seq,refseqs,padlen,reglen):
-    import SWAlign
+class WindowCache(object):
+    """class to store a bounded LRU of flank window pairs -> search result for one refseq set"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, seq_len):
+        """return (True, (isMatch, alnrec)) on a hit, (False, None) on a miss"""
+        if(key not in self.records):
+            self.misses += 1
+            return (False, None)
+        self.hits += 1
+        self.records.move_to_end(key)
+        cached = self.records[key]
+        if(cached is None):
+            return (True, (False, ""))
+        alnrec = AlignRecord()
+        (alnrec.id, alnrec.des, alnrec.ls, alnrec.le, alnrec.lscore, rsoff, reoff,
+         alnrec.rscore, alnrec.dir) = cached
+        ##right side coordinates are kept relative to the read end
+        alnrec.rs = seq_len + rsoff
+        alnrec.re = seq_len + reoff
+        return (True, (True, alnrec))
+
+    def put(self, key, seq_len, isMatch, alnrec):
+        if(isMatch):
+            self.records[key] = (alnrec.id, alnrec.des, alnrec.ls, alnrec.le, alnrec.lscore,
+                                 alnrec.rs - seq_len, alnrec.re - seq_len, alnrec.rscore, alnrec.dir)
+        else:
+            self.records[key] = None
+        if(len(self.records) > self.maxsize):
+            self.records.popitem(last=False)
+
+
+class PairDecoder(object):
+    """class to decode asymmetric barcode pairs
+
+    The forward and the reverse barcode of a read are searched on their own among the unique
+    forward and reverse barcodes, then the pair is looked up, so a plate of F x R pairs costs
+    F + R searches per read instead of F x R.
+    """
+    def __init__(self, barcodes, paras):
+        import SWAlign
+        ##only the scoring settings, the decoder is pickled into shared design files
+        self.matchscore = paras.MatchScore
+        self.maxmismatch = paras.MaxMisMatch
+        self.banded = paras.BandedAlign
+        self.pairs = {}
+        forward = OrderedDict()
+        reverse = OrderedDict()
+        for barcode in barcodes:
+            if((barcode.f, barcode.r) not in self.pairs):
+                self.pairs[(barcode.f, barcode.r)] = barcode
+            forward.setdefault(barcode.f, barcode.fs)
+            reverse.setdefault(barcode.r, barcode.rs)
+        self.forward = list(forward.items())
+        self.reverse = list(reverse.items())
+        self.forwardmatcher = AhoCorasick.AhoCorasick([seq for seq, minscore in self.forward])
+        self.reversematcher = AhoCorasick.AhoCorasick([seq for seq, minscore in self.reverse])
+        self.sw = SWAlign.LocalAlignment(SWAlign.NucleotideScoringMatrix
+                                         (paras.MatchScore, paras.MismatchScore), paras.GapScore)
+
+    def search(self, seq, seq_L, seq_Rr, padlen):
+        """return (True, alnrec) of the barcode pair in either read orientation, (False, "") if none"""
+        trim_len = len(seq) - 2*padlen
+        ##a reversed read has the reverse barcode in its left window and the forward one in its right
+        for isforward in (True, False):
+            if(isforward):
+                lhit = self._EndSearch(seq_L, self.forward, self.forwardmatcher)
+            else:
+                lhit = self._EndSearch(seq_L, self.reverse, self.reversematcher)
+            if(lhit is None):
+                continue
+            if(isforward):
+                rhit = self._EndSearch(seq_Rr, self.reverse, self.reversematcher)
+            else:
+                rhit = self._EndSearch(seq_Rr, self.forward, self.forwardmatcher)
+            if(rhit is None):
+                continue
+            pair = (lhit[0], rhit[0]) if isforward else (rhit[0], lhit[0])
+            if(pair not in self.pairs):
+                continue
+            barcode = self.pairs[pair]
+            alnrec = AlignRecord()
+            alnrec.id = barcode.id
+            alnrec.des = barcode.des
+            alnrec.ls = lhit[1]
+            alnrec.le = lhit[2]
+            alnrec.lscore = lhit[3]
+            alnrec.rs = trim_len - rhit[2] - 1
+            alnrec.re = trim_len - rhit[1] - 1
+            alnrec.rscore = rhit[3]
+            ##the barcode-free region is kept as read, primer search tries both strands
+            alnrec.dir = '+'
+            return (True, _AlignAddPad(alnrec, padlen))
+        return (False, "")
+
+    def _EndSearch(self, window, ends, matcher):
+        """return (barcode, start, end, score) of the best barcode of ends in window, None if none"""
+        hits = matcher.firstHits(window.seq)
+        if(len(hits) > 0):
+            endidx = min(hits)
+            seq = ends[endidx][0]
+            return (seq, hits[endidx], hits[endidx] + len(seq) - 1, len(seq) * self.matchscore)
+        best = None
+        for seq, minscore in ends:
+            align = _SeqAlign(seq, window, self.sw, minscore=minscore, banded=self.banded)
+            if(align['mismatch'] <= self.maxmismatch and align['score'] >= minscore):
+                if(best is None or align['score'] > best[3]):
+                    best = (seq, align['s'], align['e'], align['score'])
+        return best
+
+
+def _SeqSearch(paras,seq,refseqs,padlen,reglen,cache=None,matcher=None,decoder=None):
     seq_len = len(seq)
     totallen = padlen + reglen
     seq_L = seq[padlen:totallen]
     seq_R = seq[(seq_len - totallen):(seq_len - padlen)]
     seq_Rr = seq_R.reverse_complement()
+    if(decoder is not None):
+        search = decoder.search
+    else:
+        search = lambda seq,seq_L,seq_Rr,padlen: _WindowSearch(paras,seq,seq_L,seq_Rr,refseqs,padlen,matcher)
+    if(cache is None):
+        return search(seq,seq_L,seq_Rr,padlen)
+    key = (seq_L.seq, seq_Rr.seq, padlen)
+    isCached, result = cache.get(key, seq_len)
+    if(isCached):
+        return result
+    isMatch,alnrec = search(seq,seq_L,seq_Rr,padlen)
+    cache.put(key, seq_len, isMatch, alnrec)
+    return (isMatch,alnrec)
+
+def _WindowSearch(paras,seq,seq_L,seq_Rr,refseqs,padlen,matcher=None):
+    import SWAlign
+    seq_len = len(seq)
     trim_len = seq_len - 2*padlen
     
     alignRes = AlignRes(seq)
     sw = SWAlign.LocalAlignment(SWAlign.NucleotideScoringMatrix
                                 (paras.MatchScore, paras.MismatchScore), paras.GapScore)
     isMatch = 0       
-    isMatch,qrec = _QuickSearch(seq_L,seq_Rr,refseqs,sw,paras,trim_len)
+    isMatch,qrec = _QuickSearch(seq_L,seq_Rr,refseqs,sw,paras,trim_len,matcher)
     
     if(isMatch == 1):
         qrec = _AlignAddPad(qrec,padlen)
@@ -330,8 +697,8 @@ def _SeqSearch(paras,seq,refseqs,padlen,reglen):
     elif(isMatch == 0):
         for refseq in refseqs:
             alnrec = AlignRecord()
-            l_align = _SeqAlign(refseq.f,seq_L,sw)
-            r_align = _SeqAlign(refseq.r,seq_Rr,sw)
+            l_align = _SeqAlign(refseq.f,seq_L,sw,paras,refseq.fs)
+            r_align = _SeqAlign(refseq.r,seq_Rr,sw,paras,refseq.rs)
             if(l_align['mismatch'] <= paras.MaxMisMatch and r_align['mismatch'] <= paras.MaxMisMatch):
                 #if((l_align['score'] + r_align['score'])/2 >= self.paras.MinBarcodeScore):
                 if(l_align['score'] >= refseq.fs and r_align['score'] >= refseq.rs):
@@ -357,7 +724,17 @@ def _SeqSearch(paras,seq,refseqs,padlen,reglen):
     else:
         return (False,"")
     
-def _QuickSearch(seqL,seqR,refseqs,sw,paras,seqlen):
+def _ExactHits(lseq,rseq,refseqs,matcher):
+    """yield (refseq, posL, posR) in refseq order; with a matcher only the first hit one"""
+    if(matcher is None):
+        for refseq in refseqs:
+            yield (refseq, lseq.find(refseq.f), rseq.find(refseq.r))
+    else:
+        hit = matcher.firstHit(lseq, rseq)
+        if(hit is not None):
+            yield hit
+
+def _QuickSearch(seqL,seqR,refseqs,sw,paras,seqlen,matcher=None):
     matchscore = paras.MatchScore
     mismatchscore = paras.MismatchScore
     gapscore = paras.GapScore
@@ -367,10 +744,7 @@ def _QuickSearch(seqL,seqR,refseqs,sw,paras,seqlen):
     Matched = 0
     lseq = seqL.seq
     rseq = seqR.seq
-    for refseq in refseqs:
-        posL = lseq.find(refseq.f)
-        posR = rseq.find(refseq.r)
-        
+    for refseq, posL, posR in _ExactHits(lseq,rseq,refseqs,matcher):
         if(posL >= 0):
             alignRes.id = refseq.id
             alignRes.des = refseq.des
@@ -387,7 +761,7 @@ def _QuickSearch(seqL,seqR,refseqs,sw,paras,seqlen):
                 alignRes.rscore = refseq.rl * matchscore
                 break
             else:
-                align = _SeqAlign(refseq.r,seqR,sw)
+                align = _SeqAlign(refseq.r,seqR,sw,paras,refseq.fs)
                 if(align['mismatch'] <= maxmismatch and align['score'] >= refseq.fs):
                     Matched = 1
                     alignRes.rs = seqlen - align['e'] -1
@@ -407,7 +781,7 @@ def _QuickSearch(seqL,seqR,refseqs,sw,paras,seqlen):
                 alignRes.rs = seqlen - re -1
                 alignRes.re = seqlen - rs -1
                 alignRes.rscore = refseq.rl * matchscore
-                align = _SeqAlign(refseq.f,seqL,sw)
+                align = _SeqAlign(refseq.f,seqL,sw,paras,refseq.fs)
                 if(align['mismatch'] <= maxmismatch and align['score'] >= refseq.fs):
                     Matched = 1
                     alignRes.ls = align['s']
@@ -426,9 +800,15 @@ def _AlignAddPad(alnrec,padlen):
     return alnrec
 
 
-def _SeqAlign(ref,query,sw):
+def _SeqAlign(ref,query,sw,paras=None,minscore=None,banded=None):
+        ##alignments below minscore are rejected by the callers, so banding is safe
         query = query.seq
-        align = sw.align(ref,query)
+        if(banded is None):
+            banded = paras is not None and paras.BandedAlign
+        if(banded):
+            align = sw.align(ref,query,min_score=minscore)
+        else:
+            align = sw.align(ref,query)
         start = align.q_pos
         end = align.q_end - 1
         #align.dump()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import bz2
+import gzip
+import io
+import os
+import struct
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Thread
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+STREAM_BLOCK = 1 << 20
+##plain sequence files are parsed in byte ranges of this size
+PARSE_RANGE = 32 << 20
+##quality of every FASTA base, as loaded by the sequential reader
+FASTA_QUALITY = 50
+
+
+class QueueStream(io.RawIOBase):
+    """class to read bytes that a background thread produces block by block"""
+    def __init__(self, blocks, maxblocks=16):
+        io.RawIOBase.__init__(self)
+        self._queue = Queue(maxblocks)
+        self._block = b''
+        self._offset = 0
+        self._eof = False
+        self._error = None
+        self._stopped = False
+        self._thread = Thread(target=self._produce, args=(blocks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, blocks):
+        try:
+            for block in blocks:
+                if(not self._put(block)):
+                    return
+        except Exception as e:
+            self._error = e
+        self._put(None)
+
+    def _put(self, block):
+        while not self._stopped:
+            try:
+                self._queue.put(block, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self._offset >= len(self._block):
+            if(self._eof):
+                return 0
+            block = self._queue.get()
+            if(block is None):
+                self._eof = True
+                if(self._error is not None):
+                    raise self._error
+                return 0
+            self._block = block
+            self._offset = 0
+        size = min(len(buf), len(self._block) - self._offset)
+        buf[:size] = self._block[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        self._stopped = True
+        io.RawIOBase.close(self)
+
+
+def _StreamBlocks(opener, filename):
+    with opener(filename, 'rb') as fh_in:
+        while True:
+            block = fh_in.read(STREAM_BLOCK)
+            if(not block):
+                break
+            yield block
+
+
+def _BGZFBlockSize(header, fh_in):
+    """total size of the BGZF block starting with header, None if it is not BGZF"""
+    if(len(header) < 12 or header[:2] != GZIP_MAGIC or not (header[3] & 4)):
+        return None
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh_in.read(xlen)
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack('<BBH', extra[pos:pos+4])
+        if(si1 == 66 and si2 == 67 and slen == 2):
+            return (struct.unpack('<H', extra[pos+4:pos+6])[0] + 1, extra)
+        pos += 4 + slen
+    return None
+
+
+def _InflateBlock(block, cstart):
+    data = zlib.decompress(block[cstart:-8], -15)
+    crc, isize = struct.unpack('<II', block[-8:])
+    if(len(data) != isize or zlib.crc32(data) & 0xffffffff != crc):
+        raise IOError("Error: corrupted BGZF block")
+    return data
+
+
+def _BGZFBlocks(filename, threads):
+    """inflate BGZF blocks on a thread pool, yielding them in file order"""
+    pending = []
+    with open(filename, 'rb') as fh_in, ThreadPoolExecutor(threads) as executor:
+        while True:
+            header = fh_in.read(12)
+            if(not header):
+                break
+            blockinfo = _BGZFBlockSize(header, fh_in)
+            if(blockinfo is None):
+                raise IOError("Error: %s is not a valid BGZF file" % (filename))
+            blocksize, extra = blockinfo
+            rest = fh_in.read(blocksize - 12 - len(extra))
+            block = header + extra + rest
+            pending.append(executor.submit(_InflateBlock, block, 12 + len(extra)))
+            if(len(pending) >= threads * 4):
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def SeqFileFormat(filename):
+    """return 'bgzf', 'gzip', 'bz2' or 'plain' from the leading bytes of a file"""
+    with open(filename, 'rb') as fh_in:
+        header = fh_in.read(12)
+        if(header[:2] == GZIP_MAGIC):
+            if(_BGZFBlockSize(header, fh_in) is not None):
+                return 'bgzf'
+            return 'gzip'
+        if(header[:3] == BZIP2_MAGIC):
+            return 'bz2'
+    return 'plain'
+
+
+def OpenSeqFile(filename, threads=1):
+    """open a plain, gzip, BGZF or bzip2 sequence file as text"""
+    fileformat = SeqFileFormat(filename)
+    if(fileformat == 'plain'):
+        return open(filename, 'r')
+    if(fileformat == 'bgzf' and threads > 1):
+        blocks = _BGZFBlocks(filename, threads)
+    elif(fileformat == 'bz2'):
+        blocks = _StreamBlocks(bz2.open, filename)
+    else:
+        blocks = _StreamBlocks(gzip.open, filename)
+    return io.TextIOWrapper(io.BufferedReader(QueueStream(blocks), STREAM_BLOCK))
+
+
+def SeqFileTasks(filenames, filetype, scoretype, rangesize=PARSE_RANGE):
+    """parse tasks of all files in file order; plain files are cut into byte ranges"""
+    tasks = []
+    for filename in filenames:
+        filesize = os.path.getsize(filename)
+        if(SeqFileFormat(filename) != 'plain' or not _Splittable(filename, filetype)):
+            tasks.append((filename, None, None, filetype, scoretype))
+            continue
+        for start in range(0, max(filesize, 1), rangesize):
+            tasks.append((filename, start, min(start + rangesize, filesize), filetype, scoretype))
+    return tasks
+
+
+def ParseSeqTask(task):
+    """return (upper-case SeqRecords, mean qualities) of the records starting in one task's range"""
+    from Bio import SeqIO
+    filename, start, end, filetype, scoretype = task
+    if(start is None):
+        handle = OpenSeqFile(filename, 1)
+    else:
+        with open(filename, 'rb') as fh_in:
+            ##a record belongs to the range its header starts in
+            start = _RecordStart(fh_in, start, filetype)
+            end = _RecordStart(fh_in, end, filetype)
+            fh_in.seek(start)
+            handle = io.StringIO(fh_in.read(end - start).decode())
+    if(filetype == "FASTA"):
+        seqformat = "fasta"
+    elif(scoretype == "phred33"):
+        seqformat = "fastq-sanger"
+    else:
+        seqformat = "fastq-solexa"
+    seqs = []
+    quals = array('f')
+    try:
+        for seq in SeqIO.parse(handle, seqformat):
+            seq = seq.upper()
+            if(filetype == "FASTA"):
+                seq.letter_annotations["phred_quality"] = [FASTA_QUALITY] * len(seq)
+                quals.append(FASTA_QUALITY)
+            else:
+                scores = seq.letter_annotations["phred_quality"]
+                quals.append(sum(scores)/len(scores) if len(scores) > 0 else 0)
+            seqs.append(seq)
+    finally:
+        handle.close()
+    return (seqs, quals)
+
+
+def _Splittable(filename, filetype):
+    """FASTA always resyncs on '>', FASTQ only when it has unwrapped four-line records"""
+    if(filetype == "FASTA"):
+        return True
+    with open(filename, 'rb') as fh_in:
+        lines = [fh_in.readline() for i in range(4)]
+    return _FastqRecord(lines)
+
+
+def _FastqRecord(lines):
+    if(len(lines) < 4 or not lines[0].startswith(b'@') or not lines[2].startswith(b'+')):
+        return False
+    return len(lines[1].rstrip(b'\r\n')) == len(lines[3].rstrip(b'\r\n'))
+
+
+def _RecordStart(fh_in, pos, filetype):
+    """offset of the first record header at or after pos, the file size if there is none"""
+    if(pos == 0):
+        return 0
+    fh_in.seek(pos - 1)
+    fh_in.readline()
+    while True:
+        linestart = fh_in.tell()
+        line = fh_in.readline()
+        if(not line):
+            return linestart
+        if(filetype == "FASTA"):
+            if(line.startswith(b'>')):
+                return linestart
+            continue
+        if(not line.startswith(b'@')):
+            continue
+        ##quality lines may start with '@' too, only a header is followed by sequence and '+' lines
+        nextstart = fh_in.tell()
+        lines = [line] + [fh_in.readline() for i in range(3)]
+        if(_FastqRecord(lines)):
+            return linestart
+        fh_in.seek(nextstart)
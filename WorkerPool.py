@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import atexit
+from multiprocessing import Pool, Queue, Event
+
+_worker = {}
+_session = None
+
+
+class WorkerPool(object):
+    """class to keep one pre-warmed process pool alive for every stage of a session"""
+    def __init__(self):
+        self.threads = 0
+        self.progress = None
+        self.stopevent = None
+        self._pool = None
+
+    def pool(self, threads):
+        """return the running pool, (re)starting it when the thread count changed"""
+        if(self._pool is not None and self.threads != threads):
+            self.close()
+        if(self._pool is None):
+            self.threads = threads
+            self.progress = Queue()
+            self.stopevent = Event()
+            self._pool = Pool(threads, initializer=_InitWorker, initargs=(self.progress, self.stopevent))
+        return self._pool
+
+    def pids(self):
+        """process ids of the running workers"""
+        if(self._pool is None):
+            return []
+        return [worker.pid for worker in self._pool._pool]
+
+    def close(self):
+        if(self._pool is not None):
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self.threads = 0
+
+
+def SessionPool():
+    """the WorkerPool shared by all project environments of this process"""
+    global _session
+    if(_session is None):
+        _session = WorkerPool()
+        atexit.register(_session.close)
+    return _session
+
+
+def _InitWorker(progress, stopevent):
+    ##pay the imports of every stage once per worker
+    import SWAlign
+    import AhoCorasick
+    import SeqAlignParallel
+    import HetSearchParallel
+    import SeqFileReader
+    _worker['progress'] = progress
+    _worker['stopevent'] = stopevent
+    _worker['contexts'] = {}
+
+
+def WorkerState(key):
+    return _worker[key]
+
+
+def StageContext(stage, contextid, build, *args):
+    """return the per-worker state of a stage, rebuilt only when its contextid changes"""
+    contexts = _worker['contexts']
+    if(stage not in contexts or contexts[stage][0] != contextid):
+        contexts[stage] = (contextid, build(*args))
+    return contexts[stage][1]